@@ -0,0 +1,221 @@
+import heapq
+import hmac
+import json
+from operator import itemgetter
+import time
+from twisted.internet import task
+from twisted import logger
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from matrix_gitter import flight, metrics
+from matrix_gitter.profiler import ProfilerBusy
+
+
+log = logger.Logger()
+
+
+class AdminResource(Resource):
+    """Base class for the admin endpoints; checks the admin token.
+
+    The token is accepted either as a bearer token in the Authorization
+    header or as the `access_token` query parameter.
+    """
+    def __init__(self, bridge, token):
+        self.bridge = bridge
+        # compare_digest() doesn't compare unicode with str
+        if isinstance(token, unicode):
+            token = token.encode('utf-8')
+        self.token = token
+        Resource.__init__(self)
+
+    def render(self, request):
+        token = None
+        authorization = request.getHeader(b'authorization')
+        if authorization and authorization.startswith(b'Bearer '):
+            token = authorization[7:]
+        elif request.args.get('access_token'):
+            token = request.args['access_token'][0]
+        if not token:
+            request.setResponseCode(401)
+            return 'Missing admin token\n'
+        elif not hmac.compare_digest(token, self.token):
+            log.info("Wrong admin token from {ip}",
+                     ip=request.getClientIP())
+            request.setResponseCode(403)
+            return 'Wrong admin token\n'
+        else:
+            request.setHeader(b"content-type", b"text/plain")
+            return Resource.render(self, request)
+
+
+class Profile(AdminResource):
+    """`/admin/profile` endpoint, records a profile of the reactor thread.
+
+    POST with `seconds` (default 30) and optionally `interval` (default
+    0.005); the response is the profile in collapsed-stack format, once
+    done. The profile is also written to a file.
+    """
+    isLeaf = True
+
+    def render_POST(self, request):
+        try:
+            seconds = float(request.args.get('seconds', ['30'])[0])
+            interval = float(request.args.get('interval', ['0.005'])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Invalid parameters\n'
+        if not 0 < seconds <= 600 or not 0.0001 <= interval <= 1:
+            request.setResponseCode(400)
+            return 'Parameters out of range\n'
+
+        d = self.bridge.profiler.start(seconds, interval)
+        d.addCallbacks(self._done, self._failed,
+                       callbackArgs=(request,), errbackArgs=(request,))
+        return NOT_DONE_YET
+
+    def _done(self, (filename, content), request):
+        if not request._disconnected:
+            request.write(content)
+            request.finish()
+
+    def _failed(self, err, request):
+        if err.check(ProfilerBusy):
+            request.setResponseCode(409)
+            request.write('A profile is already running\n')
+        else:
+            log.failure("Error profiling", err)
+            request.setResponseCode(500)
+        if not request._disconnected:
+            request.finish()
+
+
+def _age(now, timestamp):
+    if timestamp is None:
+        return None
+    return round(now - timestamp, 3)
+
+
+class Rooms(AdminResource):
+    """`/admin/rooms` endpoint, lists the linked rooms and their state.
+
+    The rooms can be filtered with `state` and `user` (Matrix or GitHub
+    username). Results are sorted by Matrix room ID, `limit` at a time
+    (default 100); pass the `next` value of a page as `after` to get the
+    following one.
+
+    The rooms are scanned a batch at a time, yielding to the reactor in
+    between, so that listing doesn't block the bridge however many rooms
+    there are.
+    """
+    isLeaf = True
+
+    BATCH_SIZE = 500
+
+    def render_GET(self, request):
+        state = request.args.get('state', [None])[0]
+        user = request.args.get('user', [None])[0]
+        try:
+            if user is not None:
+                user = user.decode('utf-8')
+            after = request.args.get('after', [''])[0].decode('utf-8')
+            limit = int(request.args.get('limit', ['100'])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return 'Invalid parameters\n'
+        if not 0 < limit <= 1000:
+            request.setResponseCode(400)
+            return 'Parameters out of range\n'
+
+        result = {'states': {}, 'matched': 0}
+        page = []
+        d = task.cooperate(self._scan(state, user, after,
+                                      limit, result, page)).whenDone()
+        d.addCallback(self._done, request, limit, result, page)
+        d.addErrback(self._failed, request)
+        return NOT_DONE_YET
+
+    def _scan(self, state, user, after, limit, result, page):
+        now = time.time()
+        states = result['states']
+        # This copies the list of rooms (not the rooms themselves): we yield
+        # to the reactor between batches, and rooms can be linked or
+        # destroyed meanwhile, which would break iterating on the dict
+        for i, room in enumerate(self.bridge.rooms_matrix.values()):
+            if i % self.BATCH_SIZE == 0 and i > 0:
+                # Only keep the beginning of the page in memory
+                if len(page) > 2 * limit:
+                    page[:] = heapq.nsmallest(limit + 1, page,
+                                              key=itemgetter(0))
+                yield None
+            status = room.status(now)
+            states[status] = states.get(status, 0) + 1
+            if state is not None and status != state:
+                continue
+            if (user is not None and user != room.user.matrix_username and
+                    user != room.user.github_username):
+                continue
+            result['matched'] += 1
+            if room.matrix_room > after:
+                page.append((room.matrix_room, room, status))
+
+    def _done(self, ignored, request, limit, result, page):
+        page = heapq.nsmallest(limit + 1, page, key=itemgetter(0))
+        now = time.time()
+        rooms = []
+        for matrix_room, room, status in page[:limit]:
+            rooms.append({
+                'matrix_room': matrix_room,
+                'gitter_room': room.gitter_room_name,
+                'user': room.user.matrix_username,
+                'github_user': room.user.github_username,
+                'state': status,
+                'state_age': _age(now, room.state_since),
+                'last_data_age': _age(now, room.last_data),
+                'last_received_age': _age(now, room.last_received),
+                'last_sent_age': _age(now, room.last_sent),
+                'resources': room.resources()})
+        result['rooms'] = rooms
+        result['next'] = page[limit - 1][0] if len(page) > limit else None
+        if not request._disconnected:
+            request.setHeader(b"content-type", b"application/json")
+            request.write(json.dumps(result))
+            request.finish()
+
+    def _failed(self, err, request):
+        log.failure("Error listing rooms", err)
+        if not request._disconnected:
+            request.setResponseCode(500)
+            request.finish()
+
+
+class Events(AdminResource):
+    """`/admin/events` endpoint, dumps the flight recorder.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        return flight.format_events()
+
+
+class Metrics(AdminResource):
+    """`/metrics` endpoint, for Prometheus.
+
+    Served next to `/admin`, with the same token; configure Prometheus to
+    send it as a bearer token.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return metrics.render()
+
+
+def admin_resource(bridge, token):
+    """Build the `/admin` resource tree.
+    """
+    root = Resource()
+    root.putChild('profile', Profile(bridge, token))
+    root.putChild('rooms', Rooms(bridge, token))
+    root.putChild('events', Events(bridge, token))
+    return root
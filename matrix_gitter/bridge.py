@@ -1,18 +1,104 @@
+from collections import deque
 import json
 import os
 import sqlite3
+import time
 from twisted import logger
 from twisted.internet.protocol import Protocol, connectionDone
 
+from matrix_gitter import flight
 from matrix_gitter.gitter import GitterAPI
-from matrix_gitter.markup import matrix_to_gitter
-from matrix_gitter.matrix import MatrixAPI
-from matrix_gitter.utils import Errback, RateLimiter
+from matrix_gitter.journal import Journal
+from matrix_gitter.markup import matrix_to_gitter, Renderer
+from matrix_gitter.matrix import MatrixAPI, txid
+from matrix_gitter.metrics import Counter, Gauge, TimedConnection
+from matrix_gitter.profiler import LagMonitor, Profiler
+from matrix_gitter import tracing
+from matrix_gitter.tracing import Trace
+from matrix_gitter.utils import assert_http_200, Errback, \
+    is_transient_error, LogSummary, OutboundQueue, RateLimiter
 
 
 log = logger.Logger()
 
 
+messages_total = Counter(
+    'matrix_gitter_messages_total',
+    "Messages forwarded, by direction and outcome",
+    ['direction', 'outcome'])
+received_log = LogSummary(
+    log,
+    "Received {total} messages from Gitter in the last {interval} seconds")
+
+# All the bridges, for the metrics
+bridges = []
+
+
+def _all_rooms():
+    for bridge in bridges:
+        for room in bridge.rooms_matrix.itervalues():
+            yield room
+
+
+def _count_room_states():
+    counts = dict(((state,), 0)
+                  for state in ('connecting', 'streaming', 'stalled',
+                                'backoff'))
+    now = time.time()
+    for room in _all_rooms():
+        state = room.status(now)
+        counts[(state,)] = counts.get((state,), 0) + 1
+    return counts
+
+
+def _resources():
+    totals = {('rooms',): 0}
+    for room in _all_rooms():
+        totals[('rooms',)] += 1
+        for resource, value in room.resources().iteritems():
+            totals[(resource,)] = totals.get((resource,), 0) + value
+    return totals
+
+
+def _room_resources():
+    values = {}
+    for bridge in bridges:
+        if not bridge.metrics_per_room:
+            continue
+        for room in bridge.rooms_matrix.itervalues():
+            # Rooms are linked once per user, add those up
+            for resource, value in room.resources().iteritems():
+                key = room.gitter_room_name, resource
+                values[key] = values.get(key, 0) + value
+    return values
+
+
+Gauge('matrix_gitter_rooms',
+      "Linked rooms, by state of their Gitter stream",
+      ['state'],
+      function=_count_room_states)
+Gauge('matrix_gitter_outbound_queued',
+      "Messages waiting to be delivered to Gitter",
+      function=lambda: {(): sum(len(r.outbound) for r in _all_rooms())})
+Gauge('matrix_gitter_rendering_queued',
+      "Messages from Gitter waiting on rendering",
+      function=lambda: {(): sum(len(r.rendering) for r in _all_rooms())})
+Gauge('matrix_gitter_resources',
+      "Resources held: rooms, open streams, bytes buffered from streams, and "
+      "messages being rendered, forwarded to Matrix or queued for Gitter",
+      ['resource'],
+      function=_resources)
+Gauge('matrix_gitter_room_resources',
+      "Resources held for each Gitter room, see matrix_gitter_resources; "
+      "only if metrics_per_room is set",
+      ['room', 'resource'],
+      function=_room_resources)
+Gauge('matrix_gitter_journal_pending',
+      "Messages recorded in the journal and not yet delivered",
+      function=lambda: {(): sum(len(b.journal.entries) for b in bridges
+                                if b.journal is not None)})
+
+
 class User(object):
     """A bridge user as it appears in the database.
 
@@ -52,7 +138,30 @@ class Room(Protocol):
         self.gitter_room_id = gitter_room_id
 
         self.stream_response = None
+        self.content = []
         self.destroyed = False
+        # connecting, streaming, backoff, destroyed
+        self.state = 'connecting'
+        self.state_since = time.time()
+        # Last time we got anything on the stream, including keep-alives
+        self.last_data = None
+        # Last time we got a message from Gitter, and sent one to Gitter
+        self.last_received = None
+        self.last_sent = None
+
+        # Messages from Gitter being rendered, forwarded in order once done
+        self.rendering = deque()
+        # Messages being sent to Matrix
+        self.forwarding = 0
+
+        # Messages to Gitter, delivered in order
+        self.outbound = OutboundQueue(gitter_room_name,
+                                      self._post_to_gitter,
+                                      self._post_failed,
+                                      window=bridge.gitter_send_window,
+                                      retries=bridge.gitter_send_retries,
+                                      idempotent=False,
+                                      dropped=self._post_dropped)
 
         gitter_stream_limit.schedule(self.start_stream)
 
@@ -69,9 +178,40 @@ class Room(Protocol):
             user=self.user)
         d.addCallbacks(self._receive_stream, self.start_failed)
 
+    def _set_state(self, state):
+        self.state = state
+        self.state_since = time.time()
+
+    def status(self, now=None):
+        """Get the state for monitoring.
+
+        This is `state`, except that a stream on which nothing was received
+        for a while is reported as 'stalled'.
+        """
+        if self.state == 'streaming':
+            if now is None:
+                now = time.time()
+            last = max(self.last_data, self.state_since)
+            if now - last > self.bridge.stream_stall_timeout:
+                return 'stalled'
+        return self.state
+
+    def resources(self):
+        """Get the resources held by this room, for accounting.
+        """
+        return {'buffered_bytes': sum(len(c) for c in self.content),
+                'rendering': len(self.rendering),
+                'forwarding': self.forwarding,
+                'outbound': len(self.outbound),
+                'streams': 1 if self.stream_response is not None else 0}
+
     def start_failed(self, err):
         log.failure("Error starting Gitter stream for user {user} room {room}",
+                    err,
                     user=self.user.github_username, room=self.gitter_room_name)
+        flight.record('stream_failed', room=self.gitter_room_name,
+                      error=err.type.__name__)
+        self._set_state('backoff')
         gitter_stream_limit.fail()
         gitter_stream_limit.schedule(self.start_stream)
 
@@ -79,18 +219,25 @@ class Room(Protocol):
         log.info("Stream started for user {user} room {room}",
                  user=self.user.github_username, room=self.gitter_room_name)
         gitter_stream_limit.success()
+        flight.record('stream_connected', room=self.gitter_room_name,
+                      code=response.code)
         response.deliverBody(self)
         self.stream_response = response
+        self._set_state('streaming')
 
     def dataReceived(self, data):
         if self.destroyed:
             return
+        self.last_data = time.time()
         if '\n' in data:
             data = data.split('\n', 1)
             content, self.content = self.content + [data[0]], [data[1]]
             document = ''.join(content).strip()
             if not document:
                 return
+            trace = Trace('to_matrix')
+            self.last_received = self.last_data
+            received_log.add(self.gitter_room_name)
             log.debug("Data received on stream for user {user} room {room}:\n"
                       "{data!r}",
                       user=self.user.github_username,
@@ -104,14 +251,12 @@ class Room(Protocol):
                             user=self.user.github_username,
                             room=self.gitter_room_name)
             else:
-                log.info("Got message for user {user} room {room}: {msg!r}",
-                         user=self.user.github_username,
-                         room=self.gitter_room_name,
-                         msg=message)
                 try:
                     username = message['fromUser']['username']
                     if username != self.user.github_username:
-                        self.to_matrix(username, message['text'])
+                        trace.mark('decode')
+                        self.to_matrix(username, message['text'],
+                                       trace=trace)
                 except Exception:
                     log.failure("Exception handling Gitter message")
         else:
@@ -120,27 +265,121 @@ class Room(Protocol):
     def connectionLost(self, reason=connectionDone):
         log.info("Lost stream for user {user} room {room}",
                  user=self.user.github_username, room=self.gitter_room_name)
+        flight.record('stream_lost', room=self.gitter_room_name,
+                      reason=reason.type.__name__)
         self.stream_response = None
+        self.content = []
         if not self.destroyed:
+            self._set_state('backoff')
             gitter_stream_limit.schedule(self.start_stream)
 
-    def to_gitter(self, msg):
+    def to_gitter(self, msg, html=None, trace=None):
         """Forward a message to Gitter.
+
+        `html` is the formatted version of the message, if any.
         """
+        if trace is None:
+            trace = Trace('to_gitter')
+        text = matrix_to_gitter(msg, html)
+        trace.mark('convert')
+        journal_id = self.bridge.journal_add(
+            'to_gitter',
+            {'room': self.matrix_room, 'text': text})
+        trace.mark('journal')
+        self.outbound.put((journal_id, text, trace))
+
+    def _post_to_gitter(self, (journal_id, text, trace), attempt):
+        if attempt == 1:
+            trace.mark('queue')
+        else:
+            # Failed attempts and the delays before retrying
+            trace.mark('retry')
         d = self.bridge.gitter.gitter_request(
             'POST',
             'v1/rooms/%s/chatMessages',
-            {'text': matrix_to_gitter(msg)},
+            {'text': text},
             self.gitter_room_id,
-            user=self.user)
-        d.addErrback(Errback(log,
-                             "Error posting message to Gitter room {room}",
-                             room=self.gitter_room_name))
+            user=self.user,
+            key=self.gitter_room_id)
+        d.addCallback(assert_http_200)
+        d.addCallback(self._posted, journal_id, trace)
+        return d
 
-    def to_matrix(self, username, msg):
+    def _posted(self, response, journal_id, trace):
+        trace.mark('post')
+        self.last_sent = time.time()
+        messages_total.inc(('to_gitter', 'sent'))
+        self.bridge.journal_done(journal_id)
+        trace.finish('sent')
+
+    def _post_failed(self, (journal_id, text, trace), err):
+        trace.mark('post')
+        trace.finish('failed')
+        messages_total.inc(('to_gitter', 'failed'))
+        self.bridge.journal_done(journal_id)
+        log.info("Telling user {user} that a message to {room} failed",
+                 user=self.user.matrix_username, room=self.gitter_room_name)
+        if len(text) > 200:
+            text = text[:200] + u"..."
+        if (is_transient_error(err) and
+                not is_transient_error(err, idempotent=False)):
+            # Timed out, we don't know whether Gitter got it
+            outcome = u"might not have been delivered"
+        else:
+            outcome = u"could not be delivered"
+        self.bridge.matrix.private_message(
+            self.user,
+            u"Your message to %s %s to Gitter (%s):\n"
+            u"%s" % (self.gitter_room_name, outcome, err.getErrorMessage(),
+                     text),
+            False)
+
+    def _post_dropped(self, (journal_id, text, trace)):
+        # The room is being destroyed, the message won't be sent
+        trace.finish('dropped')
+        messages_total.inc(('to_gitter', 'dropped'))
+        self.bridge.journal_done(journal_id)
+
+    def to_matrix(self, username, msg, journal_id=None, txn_id=None,
+                  trace=None):
         """Forward a message to Matrix.
+
+        `journal_id` and `txn_id` are given when replaying the journal.
         """
-        self.bridge.matrix.forward_message(self.matrix_room, username, msg)
+        if trace is None:
+            trace = Trace('to_matrix')
+        if journal_id is None:
+            txn_id = txid()
+            journal_id = self.bridge.journal_add(
+                'to_matrix',
+                {'room': self.matrix_room, 'username': username, 'msg': msg,
+                 'txn': txn_id})
+            trace.mark('journal')
+        entry = [username, msg, None, journal_id, txn_id, trace]
+        self.rendering.append(entry)
+        d = self.bridge.renderer.gitter_to_matrix(msg)
+        d.addCallback(self._rendered, entry)
+        d.addErrback(Errback(log, "Error rendering message for room {room}",
+                             room=self.gitter_room_name))
+
+    def _rendered(self, html, entry):
+        entry[2] = html
+        entry[5].mark('render')
+        while self.rendering and self.rendering[0][2] is not None:
+            username, msg, html, journal_id, txn_id, trace = \
+                self.rendering.popleft()
+            # Time spent waiting for previous messages to be rendered
+            trace.mark('ordering')
+            self.forwarding += 1
+            d = self.bridge.matrix.forward_message(self.matrix_room, username,
+                                                   msg, html, txn_id, trace)
+            d.addCallback(self._forwarded, journal_id, trace)
+
+    def _forwarded(self, sent, journal_id, trace):
+        self.forwarding -= 1
+        messages_total.inc(('to_matrix', 'sent' if sent else 'failed'))
+        self.bridge.journal_done(journal_id)
+        trace.finish('sent' if sent else 'failed')
 
     def destroy(self):
         """Stop forwarding and remove the room from the Bridge.
@@ -149,6 +388,8 @@ class Room(Protocol):
         if self.destroyed:
             return
         self.destroyed = True
+        self._set_state('destroyed')
+        self.outbound.stop()
         if self.stream_response is not None:
             pass  # FIXME: how to close the connection?
         self.bridge.destroy_room(self)
@@ -168,7 +409,8 @@ class Bridge(object):
         self.rooms_gitter_name = {}
 
         create_db = not os.path.exists('database.sqlite3')
-        self.db = sqlite3.connect('database.sqlite3')
+        self.db = sqlite3.connect('database.sqlite3',
+                                  factory=TimedConnection)
         self.db.isolation_level = None
         self.db.row_factory = sqlite3.Row
 
@@ -228,6 +470,37 @@ class Bridge(object):
 
         self.debug = config.get('DEBUG', False)
 
+        tracing.configure(config.get('trace_sample_rate', 0),
+                          config.get('trace_file', 'traces.json'))
+        flight.configure(config.get('flight_recorder_size', 1000),
+                         config.get('flight_recorder_dir', '.'),
+                         config.get('flight_recorder_keep', 10))
+        flight.install_signal()
+        flight.install_hooks()
+
+        self.profiler = Profiler(config.get('profile_dir', '.'))
+        self.profiler.install_signal()
+        self.lag_monitor = LagMonitor(
+            threshold=config.get('reactor_lag_threshold', 1.0))
+
+        self.stream_stall_timeout = config.get('gitter_stream_stall_timeout',
+                                               90)
+        self.gitter_send_window = config.get('gitter_send_window', 1)
+        self.gitter_send_retries = config.get('gitter_send_retries', 5)
+        self.metrics_per_room = config.get('metrics_per_room', False)
+
+        journal_path = config.get('journal_path', 'journal')
+        if journal_path is not None:
+            self.journal = Journal(journal_path)
+        else:
+            self.journal = None
+
+        # Create the worker processes first, before we open any socket
+        self.renderer = Renderer(
+            processes=config.get('markup_processes', 0),
+            threshold=config.get('markup_process_threshold', 4096),
+            timeout=config.get('markup_process_timeout', 10))
+
         self.secret_key = config['unique_secret_key']
         if self.secret_key == 'change this before running':
             raise RuntimeError("Please go over the configuration and set "
@@ -245,11 +518,21 @@ class Bridge(object):
             config['matrix_botname'],
             config['matrix_appservice_token'],
             config['matrix_homeserver_token'],
-            debug=self.debug)
+            debug=self.debug,
+            bind_address=config.get('matrix_appservice_bind_address', ''),
+            admin_token=config.get('admin_token'))
 
         gitter_login_url = config['gitter_login_url']
         if gitter_login_url[-1] != '/':
             gitter_login_url += '/'
+        # Gitter endpoints can be changed, to test with a fake server
+        gitter_urls = {}
+        for name in ('api', 'stream', 'oauth'):
+            url = config.get('gitter_%s_url' % name)
+            if url is not None:
+                if url[-1] != '/':
+                    url += '/'
+                gitter_urls['%s_url' % name] = url
 
         self.gitter = GitterAPI(
             self,
@@ -257,7 +540,9 @@ class Bridge(object):
             gitter_login_url,
             config['gitter_oauth_key'],
             config['gitter_oauth_secret'],
-            debug=self.debug)
+            debug=self.debug,
+            cache_ttl=config.get('gitter_cache_ttl', 60),
+            **gitter_urls)
 
         # Initialize rooms
         cur = self.db.execute(
@@ -285,6 +570,45 @@ class Bridge(object):
                      user_m=user_obj.matrix_username,
                      user_g=user_obj.github_username)
 
+        if self.journal is not None:
+            self.replay_journal()
+
+        bridges.append(self)
+
+    def replay_journal(self):
+        """Deliver the messages that were pending when we last stopped.
+        """
+        pending = self.journal.pending()
+        if pending:
+            log.info("Replaying {nb} messages from the journal",
+                     nb=len(pending))
+        for journal_id, kind, data in pending:
+            room = self.rooms_matrix.get(data['room'])
+            if room is None:
+                # Room is gone
+                self.journal.done(journal_id)
+            elif kind == 'to_gitter':
+                room.outbound.put((journal_id, data['text'],
+                                   Trace('to_gitter')))
+            elif kind == 'to_matrix':
+                room.to_matrix(data['username'], data['msg'],
+                               journal_id, data['txn'])
+            else:
+                log.warn("Unknown journal record {kind!r}", kind=kind)
+                self.journal.done(journal_id)
+
+    def journal_add(self, kind, data):
+        """Record a message in the journal before delivery.
+        """
+        if self.journal is not None:
+            return self.journal.add(kind, data)
+
+    def journal_done(self, journal_id):
+        """Mark a message as delivered in the journal.
+        """
+        if self.journal is not None and journal_id is not None:
+            self.journal.done(journal_id)
+
     @property
     def bot_fullname(self):
         return self.matrix.bot_fullname
@@ -392,6 +716,9 @@ class Bridge(object):
 
         This assumes all his linked rooms are already gone.
         """
+        user_obj = self.get_user(matrix_user)
+        if user_obj is not None and user_obj.gitter_access_token is not None:
+            self.gitter.forget_access_token(user_obj.gitter_access_token)
         self.db.execute(
             '''
             UPDATE users SET github_username = NULL, gitter_id = NULL,
@@ -0,0 +1,406 @@
+"""Fake Gitter server, for testing the bridge without Gitter.
+
+Run it with ``python -m matrix_gitter.fake_gitter``, and point the bridge at
+it with::
+
+    gitter_api_url = 'http://127.0.0.1:8446/'
+    gitter_stream_url = 'http://127.0.0.1:8446/stream/'
+    gitter_oauth_url = 'http://127.0.0.1:8446/'
+
+It implements the parts of the REST API the bridge uses, the streaming API,
+and OAuth (approving every request). Latency, errors, rate limits and
+background traffic can be configured, see ``--help``.
+"""
+
+import argparse
+from collections import deque
+import cgi
+from datetime import datetime
+import itertools
+import json
+import random
+import sys
+import time
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted import logger
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+import urllib
+
+
+log = logger.Logger()
+
+
+class FakeGitter(object):
+    """State of the fake server: users, rooms, messages and open streams.
+
+    :param latency: Mean delay before answering REST requests, in seconds.
+    :param error_rate: Proportion of REST requests that fail with a 500.
+    :param rate_limit: Requests each token can make every `rate_window`
+        seconds, before getting 429 errors.
+    :param heartbeat: Seconds between keep-alives on streams.
+    :param stream_lifetime: If set, streams are closed after this many
+        seconds, like Gitter does from time to time.
+    :param message_rate: Messages per second posted by fake users in random
+        rooms.
+    """
+    def __init__(self, latency=0, error_rate=0, rate_limit=100,
+                 rate_window=60, heartbeat=30, stream_lifetime=None,
+                 message_rate=0, history=100):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.stream_lifetime = stream_lifetime
+        self.history = history
+
+        self.ids = itertools.count(1)
+        self.users = {}
+        self.users_by_name = {}
+        self.tokens = {}
+        self.codes = {}
+        self.rooms = {}
+        self.rooms_by_uri = {}
+        self.members = {}
+        self.messages = {}
+        self.streams = {}
+        # token -> [remaining, reset time]
+        self.budgets = {}
+
+        self.heartbeat_loop = LoopingCall(self._heartbeat)
+        self.heartbeat_loop.start(heartbeat, now=False)
+        if message_rate:
+            self.traffic_loop = LoopingCall(self._traffic)
+            self.traffic_loop.start(1.0 / message_rate, now=False)
+
+    def _new_id(self):
+        return '%024x' % next(self.ids)
+
+    def add_user(self, username):
+        """Create a user, member of all the existing rooms.
+        """
+        user = self.users_by_name.get(username)
+        if user is not None:
+            return user
+        user = {'id': self._new_id(), 'username': username,
+                'displayName': username.capitalize(),
+                'url': '/%s' % username}
+        self.users[user['id']] = user
+        self.users_by_name[username] = user
+        for room_id in self.rooms:
+            self.members[room_id].add(user['id'])
+        return user
+
+    def new_token(self, user):
+        token = 'fake%s' % self._new_id()
+        self.tokens[token] = user['id']
+        return token
+
+    def add_room(self, uri):
+        """Create a room, or get it if it exists.
+        """
+        room = self.rooms_by_uri.get(uri)
+        if room is not None:
+            return room
+        room = {'id': self._new_id(), 'name': uri, 'uri': uri,
+                'url': '/%s' % uri, 'oneToOne': False, 'userCount': 0}
+        self.rooms[room['id']] = room
+        self.rooms_by_uri[uri] = room
+        self.members[room['id']] = set()
+        self.messages[room['id']] = deque(maxlen=self.history)
+        self.streams[room['id']] = set()
+        return room
+
+    def room_json(self, room):
+        return dict(room, userCount=len(self.members[room['id']]))
+
+    def post(self, room_id, user, text):
+        """Post a message in a room, sending it to the open streams.
+        """
+        message = {'id': self._new_id(), 'text': text,
+                   'html': cgi.escape(text),
+                   'sent': datetime.utcnow().isoformat() + 'Z',
+                   'fromUser': user, 'unread': False, 'readBy': 0,
+                   'urls': [], 'mentions': [], 'issues': [], 'meta': [],
+                   'v': 1}
+        self.messages[room_id].append(message)
+        line = json.dumps(message) + '\n'
+        for request in list(self.streams[room_id]):
+            request.write(line)
+        return message
+
+    def _heartbeat(self):
+        for streams in self.streams.itervalues():
+            for request in list(streams):
+                request.write(' \n')
+
+    def _traffic(self):
+        rooms = [r for r in self.rooms if self.members[r]]
+        if not rooms:
+            return
+        user = self.add_user('traffic%d' % random.randrange(10))
+        self.post(random.choice(rooms), user,
+                  "Message at %s with *some* `markup`" % time.time())
+
+    def charge(self, token):
+        """Use a request from the token's budget.
+
+        Returns the (limit, remaining, reset) to report; remaining is
+        negative if the budget was exceeded.
+        """
+        now = time.time()
+        budget = self.budgets.get(token)
+        if budget is None or budget[1] <= now:
+            budget = self.budgets[token] = [self.rate_limit,
+                                            now + self.rate_window]
+        budget[0] -= 1
+        return self.rate_limit, budget[0], budget[1]
+
+
+def _read_json(request):
+    request.content.seek(0, 0)
+    try:
+        return json.load(request.content)
+    except ValueError:
+        return {}
+
+
+class Api(Resource):
+    """The REST API, under `/v1`.
+    """
+    isLeaf = True
+
+    def __init__(self, gitter):
+        self.gitter = gitter
+        Resource.__init__(self)
+
+    def render(self, request):
+        gitter = self.gitter
+        request.setHeader(b'content-type', b'application/json')
+
+        authorization = request.getHeader(b'authorization') or ''
+        token = authorization[7:]
+        if not authorization.startswith('Bearer ') or \
+                token not in gitter.tokens:
+            request.setResponseCode(401)
+            return '{"error":"Unauthorized"}'
+        user = gitter.users[gitter.tokens[token]]
+
+        limit, remaining, reset = gitter.charge(token)
+        request.setHeader(b'x-ratelimit-limit', b'%d' % limit)
+        request.setHeader(b'x-ratelimit-remaining', b'%d' % max(remaining, 0))
+        request.setHeader(b'x-ratelimit-reset', b'%d' % (reset * 1000))
+        if remaining < 0:
+            code, result = 429, {'error': 'Too Many Requests'}
+        elif random.random() < gitter.error_rate:
+            code, result = 500, {'error': 'Injected error'}
+        else:
+            code, result = self.handle(request, user)
+
+        request.setResponseCode(code)
+        body = json.dumps(result)
+        if not gitter.latency:
+            return body
+        reactor.callLater(random.expovariate(1.0 / gitter.latency),
+                          self._respond, request, body)
+        return NOT_DONE_YET
+
+    def _respond(self, request, body):
+        if not request._disconnected:
+            request.write(body)
+            request.finish()
+
+    def handle(self, request, user):
+        gitter = self.gitter
+        method = request.method
+        path = request.postpath
+        if path == ['user'] and method == 'GET':
+            return 200, [user]
+        elif path == ['rooms'] and method == 'GET':
+            return 200, [gitter.room_json(room)
+                         for room_id, room in gitter.rooms.iteritems()
+                         if user['id'] in gitter.members[room_id]]
+        elif path == ['rooms'] and method == 'POST':
+            uri = _read_json(request).get('uri')
+            if not uri:
+                return 400, {'error': 'Missing uri'}
+            return 200, gitter.room_json(gitter.add_room(uri))
+        elif (len(path) == 3 and path[0] == 'user' and path[2] == 'rooms' and
+                method == 'POST'):
+            room = gitter.rooms.get(_read_json(request).get('id'))
+            if path[1] != user['id'] or room is None:
+                return 404, {'error': 'Not Found'}
+            gitter.members[room['id']].add(user['id'])
+            return 200, gitter.room_json(room)
+        elif (len(path) == 4 and path[0] == 'rooms' and path[2] == 'users' and
+                method == 'DELETE'):
+            if path[1] not in gitter.rooms or path[3] != user['id']:
+                return 404, {'error': 'Not Found'}
+            gitter.members[path[1]].discard(user['id'])
+            return 200, {'success': True}
+        elif (len(path) == 3 and path[0] == 'rooms' and
+                path[2] == 'chatMessages'):
+            room_id = path[1]
+            if room_id not in gitter.rooms:
+                return 404, {'error': 'Not Found'}
+            elif user['id'] not in gitter.members[room_id]:
+                return 403, {'error': 'Forbidden'}
+            elif method == 'GET':
+                return 200, list(gitter.messages[room_id])
+            elif method == 'POST':
+                text = _read_json(request).get('text')
+                if not text:
+                    return 400, {'error': 'Missing text'}
+                return 200, gitter.post(room_id, user, text)
+        return 404, {'error': 'Not Found'}
+
+
+class Stream(Resource):
+    """The streaming API, under `/stream/v1`.
+    """
+    isLeaf = True
+
+    def __init__(self, gitter):
+        self.gitter = gitter
+        Resource.__init__(self)
+
+    def render_GET(self, request):
+        gitter = self.gitter
+        authorization = request.getHeader(b'authorization') or ''
+        token = authorization[7:]
+        path = request.postpath
+        if not authorization.startswith('Bearer ') or \
+                token not in gitter.tokens:
+            request.setResponseCode(401)
+            return '{"error":"Unauthorized"}'
+        elif (len(path) != 4 or path[:2] != ['v1', 'rooms'] or
+                path[3] != 'chatMessages' or path[2] not in gitter.rooms):
+            request.setResponseCode(404)
+            return '{"error":"Not Found"}'
+        elif gitter.tokens[token] not in gitter.members[path[2]]:
+            request.setResponseCode(403)
+            return '{"error":"Forbidden"}'
+
+        streams = gitter.streams[path[2]]
+        request.setHeader(b'content-type', b'application/json')
+        request.write(' \n')
+        streams.add(request)
+        request.notifyFinish().addBoth(lambda r: streams.discard(request))
+        if gitter.stream_lifetime:
+            reactor.callLater(gitter.stream_lifetime, self._close, request)
+        return NOT_DONE_YET
+
+    def _close(self, request):
+        if not request._disconnected and not request.finished:
+            request.finish()
+
+
+class Authorize(Resource):
+    """OAuth authorization page; approves right away.
+
+    The GitHub username is taken from the `username` parameter if given,
+    else a new user is created.
+    """
+    isLeaf = True
+
+    def __init__(self, gitter):
+        self.gitter = gitter
+        Resource.__init__(self)
+
+    def render_GET(self, request):
+        username = request.args.get('username', [None])[0]
+        if username is None:
+            username = 'user%d' % len(self.gitter.users)
+        user = self.gitter.add_user(username)
+        code = 'code%s' % self.gitter._new_id()
+        self.gitter.codes[code] = user['id']
+        request.redirect(b'%s?%s' % (
+            request.args['redirect_uri'][0],
+            urllib.urlencode({'code': code,
+                              'state': request.args['state'][0]})))
+        request.finish()
+        return NOT_DONE_YET
+
+
+class Token(Resource):
+    """OAuth token endpoint, exchanges a code for an access token.
+    """
+    isLeaf = True
+
+    def __init__(self, gitter):
+        self.gitter = gitter
+        Resource.__init__(self)
+
+    def render_POST(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        user_id = self.gitter.codes.pop(request.args.get('code', [''])[0],
+                                        None)
+        if user_id is None:
+            request.setResponseCode(400)
+            return '{"error":"invalid_grant"}'
+        token = self.gitter.new_token(self.gitter.users[user_id])
+        return json.dumps({'access_token': token, 'token_type': 'Bearer'})
+
+
+def fake_gitter_resource(gitter):
+    """Build the resource tree serving all the Gitter endpoints.
+    """
+    root = Resource()
+    root.putChild('v1', Api(gitter))
+    root.putChild('stream', Stream(gitter))
+    login = Resource()
+    root.putChild('login', login)
+    oauth = Resource()
+    login.putChild('oauth', oauth)
+    oauth.putChild('authorize', Authorize(gitter))
+    oauth.putChild('token', Token(gitter))
+    return root
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fake Gitter server, for testing the bridge")
+    parser.add_argument('--port', type=int, default=8446)
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--rooms', type=int, default=10,
+                        help="Number of rooms to create (fake/room<N>)")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Mean delay of REST responses, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Proportion of REST requests that fail")
+    parser.add_argument('--rate-limit', type=int, default=100,
+                        help="Requests allowed per token and window")
+    parser.add_argument('--rate-window', type=float, default=60,
+                        help="Length of the rate limit window, in seconds")
+    parser.add_argument('--heartbeat', type=float, default=30,
+                        help="Seconds between keep-alives on streams")
+    parser.add_argument('--stream-lifetime', type=float, default=None,
+                        help="Close streams after that many seconds")
+    parser.add_argument('--message-rate', type=float, default=0,
+                        help="Messages per second posted in random rooms")
+    args = parser.parse_args()
+
+    observer = logger.FileLogObserver(sys.stderr,
+                                      logger.formatEventAsClassicLogText)
+    logger.globalLogBeginner.beginLoggingTo([observer],
+                                            redirectStandardIO=False)
+
+    gitter = FakeGitter(latency=args.latency, error_rate=args.error_rate,
+                        rate_limit=args.rate_limit,
+                        rate_window=args.rate_window,
+                        heartbeat=args.heartbeat,
+                        stream_lifetime=args.stream_lifetime,
+                        message_rate=args.message_rate)
+    for i in xrange(args.rooms):
+        gitter.add_room('fake/room%d' % i)
+
+    site = Site(fake_gitter_resource(gitter))
+    reactor.listenTCP(args.port, site, interface=args.interface)
+    log.info("Fake Gitter listening on {interface}:{port}",
+             interface=args.interface, port=args.port)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,481 @@
+"""Fake Matrix homeserver, for testing and benchmarking the bridge.
+
+Run it with ``python -m matrix_gitter.fake_homeserver``, and point the bridge
+at it with ``matrix_homeserver_url = 'http://127.0.0.1:8448/'``; the tokens
+and domain have to match the bridge's settings, see ``--help``.
+
+It implements the client-server API calls the bridge makes, and pushes the
+resulting events to the application service in `/transactions/<txid>`
+batches, one at a time, like Synapse. Latency, rate limiting and errors can
+be configured; request counts and latencies are kept per endpoint and can be
+read from `/_fake/stats`.
+
+Synthetic traffic can be generated with ``--users``: each user opens a
+private chat with the bridge bot, and ``--message-rate`` messages per second
+are then sent by those users in the rooms they are in.
+"""
+
+import argparse
+from collections import deque
+import itertools
+import json
+import random
+import sys
+import time
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted import logger
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+import urllib
+
+from matrix_gitter.utils import JsonProducer
+
+
+log = logger.Logger()
+
+
+class MatrixError(Exception):
+    def __init__(self, code, errcode, error, **extra):
+        Exception.__init__(self, error)
+        self.code = code
+        self.content = dict(extra, errcode=errcode, error=error)
+
+
+class EndpointStats(object):
+    """Number of requests, by status code, and latency for an endpoint.
+    """
+    def __init__(self):
+        self.codes = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, code, duration):
+        self.codes[code] = self.codes.get(code, 0) + 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def to_json(self):
+        return {'count': self.count,
+                'codes': self.codes,
+                'mean_seconds': self.total / self.count if self.count else 0,
+                'max_seconds': self.max}
+
+
+class FakeHomeserver(object):
+    """State of the fake homeserver: users, rooms, and events to push.
+
+    :param appservice_url: Where to push transactions.
+    :param as_token: Token the application service uses.
+    :param hs_token: Token we send to the application service.
+    :param botname: Localpart of the application service's bot.
+    :param latency: Mean delay before answering requests, in seconds.
+    :param error_rate: Proportion of requests that fail with a 500.
+    :param rate_limit: Requests per second allowed for each user (0 for no
+        limit), before getting M_LIMIT_EXCEEDED errors.
+    :param batch_size: Maximum number of events per transaction.
+    """
+    def __init__(self, appservice_url, as_token, hs_token, domain,
+                 botname='gitter', latency=0, error_rate=0, rate_limit=0,
+                 batch_size=50):
+        if appservice_url[-1] != '/':
+            appservice_url += '/'
+        self.appservice_url = appservice_url
+        self.as_token = as_token
+        self.hs_token = hs_token
+        self.domain = domain
+        self.bot = '@%s:%s' % (botname, domain)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.batch_size = batch_size
+
+        self.ids = itertools.count(1)
+        self.users = {}
+        # room_id -> {user: membership}
+        self.rooms = {}
+        # (user, txn_id) -> event_id
+        self.txns = {}
+        # user -> [allowance, last time]
+        self.buckets = {}
+        # Synthetic users, who accept invites, and their private chats
+        self.clients = set()
+        self.private_rooms = set()
+
+        self.pending = deque()
+        self.pushing = False
+        # Transaction being sent, kept until it succeeds
+        self.transaction = None
+        self.agent = Agent(reactor)
+        self.txn_ids = itertools.count(1)
+
+        self.stats = {}
+        self.transactions = EndpointStats()
+
+    def _new_id(self, sigil):
+        return '%s%d:%s' % (sigil, next(self.ids), self.domain)
+
+    def record(self, endpoint, code, duration):
+        stats = self.stats.get(endpoint)
+        if stats is None:
+            stats = self.stats[endpoint] = EndpointStats()
+        stats.record(code, duration)
+
+    def stats_json(self):
+        return {'endpoints': dict((k, v.to_json())
+                                  for k, v in self.stats.iteritems()),
+                'transactions': self.transactions.to_json(),
+                'pending_events': len(self.pending)}
+
+    def charge(self, user):
+        """Take a request from a user's allowance, raising if exhausted.
+        """
+        if not self.rate_limit:
+            return
+        now = time.time()
+        bucket = self.buckets.get(user)
+        if bucket is None:
+            bucket = self.buckets[user] = [self.rate_limit, now]
+        bucket[0] = min(self.rate_limit,
+                        bucket[0] + (now - bucket[1]) * self.rate_limit)
+        bucket[1] = now
+        if bucket[0] < 1:
+            raise MatrixError(
+                429, 'M_LIMIT_EXCEEDED', "Too many requests",
+                retry_after_ms=int((1 - bucket[0]) / self.rate_limit * 1000))
+        bucket[0] -= 1
+
+    # State changes
+
+    def register(self, localpart):
+        user = '@%s:%s' % (localpart, self.domain)
+        if user in self.users:
+            raise MatrixError(400, 'M_USER_IN_USE', "User ID already taken")
+        self.users[user] = {'displayname': None}
+        return user
+
+    def create_room(self, creator, invite=()):
+        room = self._new_id('!')
+        self.rooms[room] = {}
+        self.set_membership(room, creator, creator, 'join')
+        for user in invite:
+            self.set_membership(room, creator, user, 'invite')
+        return room
+
+    def _room(self, room):
+        if room not in self.rooms:
+            raise MatrixError(404, 'M_NOT_FOUND', "Unknown room")
+        return self.rooms[room]
+
+    def set_membership(self, room, sender, target, membership):
+        members = self._room(room)
+        if membership == 'invite' and members.get(sender) != 'join':
+            raise MatrixError(403, 'M_FORBIDDEN', "Not in room")
+        if membership == 'invite' and members.get(target) == 'join':
+            raise MatrixError(403, 'M_FORBIDDEN', "Already in the room")
+        if (membership == 'join' and members and
+                members.get(target) not in ('invite', 'join')):
+            raise MatrixError(403, 'M_FORBIDDEN', "Not invited")
+        if target not in self.users:
+            self.users[target] = {'displayname': None}
+        if membership == 'leave':
+            members.pop(target, None)
+        else:
+            members[target] = membership
+        self.event(room, sender, 'm.room.member',
+                   {'membership': membership}, state_key=target)
+        if membership == 'invite' and target in self.clients:
+            reactor.callLater(0, self.set_membership,
+                              room, target, target, 'join')
+
+    def send(self, room, sender, content, txn_id=None):
+        if txn_id is not None and (sender, txn_id) in self.txns:
+            return self.txns[(sender, txn_id)]
+        if self._room(room).get(sender) != 'join':
+            raise MatrixError(403, 'M_FORBIDDEN', "Not in room")
+        event_id = self.event(room, sender, 'm.room.message', content)
+        if txn_id is not None:
+            self.txns[(sender, txn_id)] = event_id
+        return event_id
+
+    def event(self, room, sender, type_, content, state_key=None):
+        """Record an event and queue it for the application service.
+        """
+        event = {'event_id': self._new_id('$'), 'room_id': room,
+                 'user_id': sender, 'sender': sender, 'type': type_,
+                 'content': content,
+                 'origin_server_ts': int(time.time() * 1000)}
+        if state_key is not None:
+            event['state_key'] = state_key
+        self.pending.append(event)
+        if not self.pushing:
+            reactor.callLater(0, self._push)
+        return event['event_id']
+
+    # Pushing transactions
+
+    def _push(self):
+        if self.pushing:
+            return
+        if self.transaction is None:
+            if not self.pending:
+                return
+            events = []
+            while self.pending and len(events) < self.batch_size:
+                events.append(self.pending.popleft())
+            self.transaction = next(self.txn_ids), events
+        self.pushing = True
+        txn_id, events = self.transaction
+        uri = '%stransactions/%d?%s' % (
+            self.appservice_url, txn_id,
+            urllib.urlencode({'access_token': self.hs_token}))
+        start = time.time()
+        d = self.agent.request(
+            'PUT', uri,
+            Headers({'content-type': ['application/json']}),
+            JsonProducer({'events': events}))
+        d.addCallback(lambda response: readBody(response).addCallback(
+            lambda body: response.code))
+        d.addBoth(self._pushed, start)
+
+    def _pushed(self, result, start):
+        code = result if isinstance(result, int) else 'error'
+        self.transactions.record(code, time.time() - start)
+        if code != 200:
+            # Retry the same transaction, other events wait
+            log.warn("Transaction {txn} failed ({code}), retrying",
+                     txn=self.transaction[0], code=code)
+            reactor.callLater(1, self._retry)
+        else:
+            self.transaction = None
+            self.pushing = False
+            self._push()
+
+    def _retry(self):
+        self.pushing = False
+        self._push()
+
+    # Synthetic users
+
+    def add_user(self, localpart):
+        """Create a real user, who opens a private chat with the bot.
+        """
+        user = '@%s:%s' % (localpart, self.domain)
+        self.users.setdefault(user, {'displayname': None})
+        self.clients.add(user)
+        self.private_rooms.add(self.create_room(user, [self.bot]))
+        return user
+
+    def say(self, user, room, text):
+        return self.send(room, user, {'msgtype': 'm.text', 'body': text})
+
+    def random_message(self):
+        """Send a message from a synthetic user in a random linked room.
+        """
+        choices = [(room, user)
+                   for room, members in self.rooms.iteritems()
+                   if room not in self.private_rooms
+                   for user, membership in members.iteritems()
+                   if membership == 'join' and user in self.clients]
+        if choices:
+            room, user = random.choice(choices)
+            self.say(user, room, "Message at %s with *markup*" % time.time())
+
+
+def endpoint_name(method, path):
+    """Name of an endpoint for the statistics, without the IDs in the path.
+
+    For example, ``PUT rooms/%s/send/m.room.message/%s``.
+    """
+    path = list(path)
+    if len(path) >= 2 and path[0] in ('rooms', 'profile', 'join'):
+        path[1] = '%s'
+    if len(path) >= 5 and path[0] == 'rooms' and path[2] == 'send':
+        path[4] = '%s'
+    return '%s %s' % (method, '/'.join(path))
+
+
+class ClientApi(Resource):
+    """The client-server API, under `/_matrix/client/r0`.
+    """
+    isLeaf = True
+
+    def __init__(self, homeserver):
+        self.homeserver = homeserver
+        Resource.__init__(self)
+
+    def render(self, request):
+        hs = self.homeserver
+        start = time.time()
+        request.setHeader(b'content-type', b'application/json')
+        endpoint = endpoint_name(request.method, request.postpath)
+        try:
+            token = request.args.get('access_token', [None])[0]
+            if token != hs.as_token:
+                raise MatrixError(401, 'M_UNKNOWN_TOKEN', "Unknown token")
+            user = request.args.get('user_id', [hs.bot])[0]
+            hs.charge(user)
+            if random.random() < hs.error_rate:
+                raise MatrixError(500, 'M_UNKNOWN', "Injected error")
+            request.content.seek(0, 0)
+            body = request.content.read()
+            content = json.loads(body) if body else {}
+            result = self.handle(request.method, request.postpath, user,
+                                 content)
+            code = 200
+        except MatrixError as e:
+            code, result = e.code, e.content
+        except (ValueError, KeyError, IndexError):
+            code, result = 400, {'errcode': 'M_BAD_JSON',
+                                 'error': "Invalid request"}
+        request.setResponseCode(code)
+        body = json.dumps(result)
+        if not hs.latency:
+            hs.record(endpoint, code, time.time() - start)
+            return body
+        reactor.callLater(random.expovariate(1.0 / hs.latency),
+                          self._respond, request, body, endpoint, code, start)
+        return NOT_DONE_YET
+
+    def _respond(self, request, body, endpoint, code, start):
+        self.homeserver.record(endpoint, code, time.time() - start)
+        if not request._disconnected:
+            request.write(body)
+            request.finish()
+
+    def handle(self, method, path, user, content):
+        """Handle a request, returning the response's content.
+        """
+        hs = self.homeserver
+        if path == ['register'] and method == 'POST':
+            return {'user_id': hs.register(content['username'])}
+        elif (len(path) == 3 and path[0] == 'profile' and
+                path[2] == 'displayname' and method == 'PUT'):
+            if path[1] != user:
+                raise MatrixError(403, 'M_FORBIDDEN', "Not your profile")
+            hs.users.setdefault(user, {})['displayname'] = \
+                content['displayname']
+            return {}
+        elif path == ['createRoom'] and method == 'POST':
+            return {'room_id': hs.create_room(user,
+                                              content.get('invite', ()))}
+        elif len(path) == 2 and path[0] == 'join' and method == 'POST':
+            hs.set_membership(path[1], user, user, 'join')
+            return {'room_id': path[1]}
+        elif len(path) >= 3 and path[0] == 'rooms':
+            room, action = path[1], path[2]
+            if action == 'invite' and method == 'POST':
+                hs.set_membership(room, user, content['user_id'], 'invite')
+                return {}
+            elif action == 'join' and method == 'POST':
+                hs.set_membership(room, user, user, 'join')
+                return {'room_id': room}
+            elif action == 'leave' and method == 'POST':
+                hs.set_membership(room, user, user, 'leave')
+                return {}
+            elif action == 'forget' and method == 'POST':
+                hs._room(room)
+                return {}
+            elif action == 'members' and method == 'GET':
+                return {'chunk': [
+                    {'type': 'm.room.member', 'room_id': room,
+                     'state_key': member,
+                     'content': {'membership': membership}}
+                    for member, membership in hs._room(room).iteritems()]}
+            elif (action == 'send' and len(path) == 5 and
+                    method == 'PUT'):
+                return {'event_id': hs.send(room, user, content, path[4])}
+        raise MatrixError(404, 'M_UNRECOGNIZED', "Unrecognized request")
+
+
+class Stats(Resource):
+    """`/_fake/stats`, request counts and latency per endpoint.
+    """
+    isLeaf = True
+
+    def __init__(self, homeserver):
+        self.homeserver = homeserver
+        Resource.__init__(self)
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(self.homeserver.stats_json(), indent=2,
+                          sort_keys=True)
+
+
+def fake_homeserver_resource(homeserver):
+    """Build the resource tree serving the homeserver endpoints.
+    """
+    root = Resource()
+    matrix = Resource()
+    root.putChild('_matrix', matrix)
+    client = Resource()
+    matrix.putChild('client', client)
+    client.putChild('r0', ClientApi(homeserver))
+    fake = Resource()
+    root.putChild('_fake', fake)
+    fake.putChild('stats', Stats(homeserver))
+    return root
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fake Matrix homeserver, for testing the bridge")
+    parser.add_argument('--port', type=int, default=8448)
+    parser.add_argument('--interface', default='127.0.0.1')
+    parser.add_argument('--appservice-url', default='http://127.0.0.1:8445/')
+    parser.add_argument('--as-token', default='changeme42changeme',
+                        help="matrix_appservice_token in the settings")
+    parser.add_argument('--hs-token', default='changeme42changeme',
+                        help="matrix_homeserver_token in the settings")
+    parser.add_argument('--domain', default='localhost',
+                        help="matrix_homeserver_domain in the settings")
+    parser.add_argument('--botname', default='gitter',
+                        help="Localpart of matrix_botname in the settings")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Mean delay of responses, in seconds")
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help="Proportion of requests that fail")
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="Requests per second allowed for each user")
+    parser.add_argument('--batch-size', type=int, default=50,
+                        help="Maximum number of events per transaction")
+    parser.add_argument('--users', type=int, default=0,
+                        help="Users opening a chat with the bot at start")
+    parser.add_argument('--message-rate', type=float, default=0,
+                        help="Messages per second from those users")
+    args = parser.parse_args()
+
+    observer = logger.FileLogObserver(sys.stderr,
+                                      logger.formatEventAsClassicLogText)
+    logger.globalLogBeginner.beginLoggingTo([observer],
+                                            redirectStandardIO=False)
+
+    homeserver = FakeHomeserver(
+        args.appservice_url, args.as_token, args.hs_token, args.domain,
+        botname=args.botname, latency=args.latency,
+        error_rate=args.error_rate, rate_limit=args.rate_limit,
+        batch_size=args.batch_size)
+    for i in xrange(args.users):
+        homeserver.add_user('user%d' % i)
+    if args.message_rate:
+        LoopingCall(homeserver.random_message).start(1.0 / args.message_rate,
+                                                     now=False)
+
+    site = Site(fake_homeserver_resource(homeserver))
+    reactor.listenTCP(args.port, site, interface=args.interface)
+    log.info("Fake homeserver listening on {interface}:{port}",
+             interface=args.interface, port=args.port)
+    reactor.addSystemEventTrigger(
+        'before', 'shutdown',
+        lambda: sys.stderr.write(json.dumps(homeserver.stats_json(),
+                                            indent=2, sort_keys=True) + '\n'))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
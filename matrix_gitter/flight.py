@@ -0,0 +1,163 @@
+from collections import deque
+from datetime import datetime
+import os
+import re
+import signal
+import sys
+import time
+from twisted.internet import reactor
+from twisted import logger
+
+
+log = logger.Logger()
+
+
+_events = deque(maxlen=1000)
+_directory = '.'
+_keep = 10
+_last_auto_dump = 0
+
+_dump_re = re.compile(r'^flight-[0-9]{8}-[0-9]{6}-[0-9]{6}\.log$')
+
+AUTO_DUMP_INTERVAL = 60
+
+
+def configure(size, directory, keep=10):
+    """Set the number of events to keep and where to write dumps.
+
+    Only the last `keep` dumps are kept in the directory (None for all).
+    """
+    global _events, _directory, _keep
+    _events = deque(_events, maxlen=size)
+    _directory = directory
+    _keep = keep
+
+
+def record(kind, **fields):
+    """Record an event.
+
+    This only appends to a bounded deque, so it is cheap enough to call on
+    every request. The fields should be small values such as numbers and
+    short strings, not messages, so that the memory used stays bounded.
+    """
+    _events.append((time.time(), kind, fields))
+
+
+def observe(event):
+    """Log observer recording warnings and errors.
+
+    Failures also trigger a dump to a file, at most once a minute.
+    """
+    global _last_auto_dump
+    level = event.get('log_level')
+    failure = event.get('log_failure')
+    if failure is None and level not in (logger.LogLevel.warn,
+                                         logger.LogLevel.error,
+                                         logger.LogLevel.critical):
+        return
+    fields = {'namespace': event.get('log_namespace'),
+              'text': logger.formatEvent(event)[:500]}
+    if failure is not None:
+        fields['error'] = ('%s: %s' % (failure.type.__name__,
+                                       failure.getErrorMessage()))[:500]
+        record('failure', **fields)
+        now = time.time()
+        if now - _last_auto_dump >= AUTO_DUMP_INTERVAL:
+            _last_auto_dump = now
+            dump_file()
+    else:
+        record(level.name, **fields)
+
+
+def format_events():
+    """Get the recorded events as text, oldest first.
+    """
+    lines = []
+    for timestamp, kind, fields in list(_events):
+        lines.append('%s %s %s\n' % (
+            datetime.utcfromtimestamp(timestamp).isoformat(),
+            kind,
+            ' '.join('%s=%r' % (k, v) for k, v in sorted(fields.iteritems()))))
+    return ''.join(lines)
+
+
+def dump_file():
+    """Write the recorded events to a new file, returning its name.
+    """
+    filename = os.path.join(
+        _directory,
+        datetime.now().strftime('flight-%Y%m%d-%H%M%S-%f.log'))
+    try:
+        with open(filename, 'wb') as fp:
+            fp.write(format_events())
+    except IOError:
+        # Don't log a failure, we might be called from the log observer
+        log.error("Error writing flight recorder to {file}", file=filename)
+        return None
+    record('dump', file=filename)
+    _remove_old_dumps()
+    return filename
+
+
+def _remove_old_dumps():
+    if _keep is None:
+        return
+    try:
+        # The names sort by date
+        names = sorted(name for name in os.listdir(_directory)
+                       if _dump_re.match(name))
+    except OSError:
+        log.error("Error listing flight recorder dumps in {dir}",
+                  dir=_directory)
+        return
+    for name in names[:max(0, len(names) - _keep)]:
+        try:
+            os.remove(os.path.join(_directory, name))
+        except OSError:
+            log.error("Error removing flight recorder dump {file}",
+                      file=name)
+
+
+def install_signal(signum=getattr(signal, 'SIGUSR2', None)):
+    """Dump the recorded events to a file when sent a signal.
+
+    The default signal is SIGUSR2; it is not available on Windows.
+    """
+    if signum is None:
+        return
+
+    def handler(signum, frame):
+        reactor.callFromThread(_from_signal)
+    signal.signal(signum, handler)
+
+
+def _from_signal():
+    filename = dump_file()
+    if filename is not None:
+        log.info("Wrote flight recorder to {file}", file=filename)
+
+
+def install_hooks():
+    """Dump the recorded events on shutdown and on uncaught exceptions.
+
+    Failures that get logged already cause a dump, see `observe()`; this
+    covers the events leading to a restart, and exceptions that escape
+    everything (for example while starting up).
+    """
+    reactor.addSystemEventTrigger('before', 'shutdown', _on_shutdown)
+
+    previous = sys.excepthook
+
+    def excepthook(type_, value, tb):
+        record('uncaught',
+               error=('%s: %s' % (type_.__name__, value))[:500])
+        dump_file()
+        previous(type_, value, tb)
+    sys.excepthook = excepthook
+
+
+def _on_shutdown():
+    record('shutdown')
+    filename = dump_file()
+    if filename is not None:
+        log.info("Wrote flight recorder to {file}", file=filename)
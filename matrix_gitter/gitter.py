@@ -1,16 +1,205 @@
 import hashlib
 import hmac
+import time
 from twisted import logger
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.web.client import readBody
 import urllib
 
+from matrix_gitter import flight
 from matrix_gitter.gitter_oauth import setup_gitter_oauth
+from matrix_gitter.metrics import Gauge
 from matrix_gitter.utils import assert_http_200, Errback, JsonProducer, \
-    read_json_response, http_request
+    read_json_array, read_json_response, http_request, RequestCache, \
+    timer_wheel
 
 
 log = logger.Logger()
 
 
+def _header_int(headers, name):
+    values = headers.getRawHeaders(name)
+    if not values:
+        return None
+    try:
+        return int(float(values[-1]))
+    except ValueError:
+        return None
+
+
+class RateLimitedScheduler(object):
+    """Schedules the requests made with an access token, within rate limits.
+
+    Gitter reports the budget of each token in X-RateLimit-* headers. Once it
+    is used up, requests are held back until it resets instead of failing, and
+    requests that get a 429 anyway are retried after the reset.
+
+    Requests with the same key (for example, messages to a room) are made one
+    at a time, in order.
+    """
+    def __init__(self, name, retries=5, default_wait=60):
+        self.name = name
+        self.retries = retries
+        self.default_wait = default_wait
+
+        # Budget as of the last response, None if unknown
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+
+        self.queue = []
+        self.in_flight = 0
+        self.busy_keys = set()
+        self.wakeup = None
+
+    def request(self, key, function, *args, **kwargs):
+        """Schedule a request, returning a Deferred of the response.
+
+        `function` is called with `args` and `kwargs` to make the request,
+        possibly several times.
+        """
+        d = defer.Deferred()
+        self.queue.append([key, function, args, kwargs, d, 0])
+        self._pump()
+        return d
+
+    def status(self):
+        """Budget gauges for this token.
+        """
+        now = time.time()
+        return {'name': self.name,
+                'limit': self.limit,
+                'remaining': self.remaining,
+                'reset_in': (max(0, self.reset - now)
+                             if self.reset is not None else None),
+                'queued': len(self.queue),
+                'in_flight': self.in_flight}
+
+    def _available(self, now):
+        if self.reset is not None and now >= self.reset:
+            # Budget has been refilled
+            self.remaining = self.limit
+            self.reset = None
+        return self.remaining is None or self.remaining > self.in_flight
+
+    def _pump(self):
+        now = time.time()
+        busy = set(self.busy_keys)
+        i = 0
+        while i < len(self.queue):
+            key = self.queue[i][0]
+            if key is not None and key in busy:
+                # Wait for the previous request with that key
+                i += 1
+            elif not self._available(now):
+                self._wait(now)
+                return
+            else:
+                job = self.queue.pop(i)
+                if key is not None:
+                    busy.add(key)
+                    self.busy_keys.add(key)
+                self._start(job)
+
+    def _wait(self, now):
+        if self.wakeup is not None and self.wakeup.active():
+            return
+        if self.reset is None:
+            self.reset = now + self.default_wait
+        delay = max(0, self.reset - now)
+        log.info("Rate limit reached for {name}, {queued} requests queued, "
+                 "waiting {delay:.1f}s",
+                 name=self.name, queued=len(self.queue), delay=delay)
+        flight.record('rate_limited', name=self.name, queued=len(self.queue),
+                      delay=round(delay, 3))
+        self.wakeup = timer_wheel.call_later(delay, self._pump)
+
+    def _start(self, job):
+        key, function, args, kwargs, d, attempts = job
+        self.in_flight += 1
+        r = defer.maybeDeferred(function, *args, **kwargs)
+        r.addBoth(self._completed, job)
+
+    def _completed(self, result, job):
+        key, function, args, kwargs, d, attempts = job
+        self.in_flight -= 1
+        self.busy_keys.discard(key)
+        if not isinstance(result, Failure):
+            now = time.time()
+            self._update(result.headers, now)
+            if result.code == 429 and attempts < self.retries:
+                # Out of budget: retry after the reset, before anything else
+                # with that key
+                retry_after = _header_int(result.headers, 'retry-after')
+                self.remaining = 0
+                if retry_after is not None:
+                    self.reset = now + retry_after
+                elif self.reset is None:
+                    self.reset = now + self.default_wait
+                log.info("Got 429 for {name}, will retry", name=self.name)
+                flight.record('rate_limit_429', name=self.name,
+                              attempts=attempts)
+                readBody(result).addErrback(lambda err: None)
+                job[5] += 1
+                self.queue.insert(0, job)
+                self._pump()
+                return
+        self._pump()
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def _update(self, headers, now):
+        """Update the budget from the headers of a response.
+        """
+        limit = _header_int(headers, 'x-ratelimit-limit')
+        remaining = _header_int(headers, 'x-ratelimit-remaining')
+        reset = _header_int(headers, 'x-ratelimit-reset')
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+            if reset is None:
+                self.reset = now + self.default_wait
+            elif reset > 100000000000:
+                # Milliseconds since the epoch
+                self.reset = reset / 1000.0
+            elif reset > 1000000000:
+                # Seconds since the epoch
+                self.reset = reset
+            else:
+                # Seconds from now
+                self.reset = now + reset
+
+
+# All the GitterAPI objects, for the metrics
+gitter_apis = []
+
+
+def _rate_limit_totals():
+    totals = {'queued': 0, 'in_flight': 0, 'exhausted': 0}
+    for api in gitter_apis:
+        for status in api.rate_limit_status():
+            totals['queued'] += status['queued']
+            totals['in_flight'] += status['in_flight']
+            if status['remaining'] == 0:
+                totals['exhausted'] += 1
+    return totals
+
+
+Gauge('matrix_gitter_gitter_ratelimit_queued',
+      "Requests to Gitter waiting on the budget of their user",
+      function=lambda: {(): _rate_limit_totals()['queued']})
+Gauge('matrix_gitter_gitter_ratelimit_in_flight',
+      "Requests to Gitter in flight",
+      function=lambda: {(): _rate_limit_totals()['in_flight']})
+Gauge('matrix_gitter_gitter_ratelimit_exhausted',
+      "Gitter users whose request budget is used up",
+      function=lambda: {(): _rate_limit_totals()['exhausted']})
+
+
 class GitterAPI(object):
     """Gitter interface.
 
@@ -18,12 +207,27 @@ class GitterAPI(object):
     specific users.
     """
     def __init__(self, bridge, port, url, oauth_key, oauth_secret,
-                 debug=False):
+                 debug=False, cache_ttl=60,
+                 api_url='https://api.gitter.im/',
+                 stream_url='https://stream.gitter.im/',
+                 oauth_url='https://gitter.im/'):
         self.bridge = bridge
 
         self.oauth_key = oauth_key
         self.oauth_secret = oauth_secret
         self.url = url
+        self.api_url = api_url
+        self.stream_url = stream_url
+        self.oauth_url = oauth_url
+
+        # Lookups are cached per access token, since what users can see
+        # differs
+        self.user_rooms_cache = RequestCache('user_rooms', cache_ttl)
+        self.room_cache = RequestCache('room', cache_ttl)
+
+        # Request schedulers, per access token
+        self.schedulers = {}
+        gitter_apis.append(self)
 
         setup_gitter_oauth(self, port, debug=debug)
 
@@ -38,11 +242,19 @@ class GitterAPI(object):
 
     def gitter_request(self, method, uri, content, *args, **kwargs):
         """Gitter API request.
+
+        Requests are scheduled according to the token's rate limit. Requests
+        with the same `key` are made in order.
         """
+        key = kwargs.pop('key', None)
         if 'access_token' in kwargs:
             access_token = kwargs.pop('access_token')
+            name = None
         else:
-            access_token = kwargs.pop('user').gitter_access_token
+            user_obj = kwargs.pop('user')
+            access_token = user_obj.gitter_access_token
+            name = user_obj.github_username
+        endpoint = uri
         if args:
             uri = uri % tuple(urllib.quote(a) for a in args)
         if isinstance(uri, unicode):
@@ -53,11 +265,34 @@ class GitterAPI(object):
             headers['content-type'] = 'application/json'
         log.debug("gitter_request {method} {uri} {content!r}",
                   method=method, uri=uri, content=content)
-        return http_request(
+        scheduler = self.schedulers.get(access_token)
+        if scheduler is None:
+            scheduler = RateLimitedScheduler(name or 'new user')
+            self.schedulers[access_token] = scheduler
+        elif name is not None:
+            scheduler.name = name
+        return scheduler.request(
+            key,
+            http_request,
             method,
-            'https://api.gitter.im/%s' % uri,
+            '%s%s' % (self.api_url, uri),
             headers,
-            JsonProducer(content) if content is not None else None)
+            JsonProducer(content) if content is not None else None,
+            endpoint=endpoint)
+
+    def forget_access_token(self, access_token):
+        """Drop the state kept for an access token that is no longer used.
+        """
+        scheduler = self.schedulers.get(access_token)
+        if (scheduler is not None and
+                not scheduler.queue and not scheduler.in_flight):
+            del self.schedulers[access_token]
+        self._invalidate_token(access_token)
+
+    def rate_limit_status(self):
+        """Get the budget gauges for all access tokens.
+        """
+        return [s.status() for s in self.schedulers.itervalues()]
 
     def gitter_stream(self, method, uri, *args, **kwargs):
         """Request to Gitter's streaming API.
@@ -66,6 +301,7 @@ class GitterAPI(object):
             access_token = kwargs.pop('access_token')
         else:
             access_token = kwargs.pop('user').gitter_access_token
+        endpoint = uri
         if args:
             uri = uri % tuple(urllib.quote(a) for a in args)
         if isinstance(uri, unicode):
@@ -76,9 +312,11 @@ class GitterAPI(object):
                   method=method, uri=uri)
         return http_request(
             method,
-            'https://stream.gitter.im/%s' % uri,
+            '%s%s' % (self.stream_url, uri),
             headers,
-            timeout=None)
+            timeout=None,
+            compress=False,
+            endpoint=endpoint)
 
     def set_access_token(self, matrix_user, access_token):
         """Set the access token for a user who completed OAuth.
@@ -106,20 +344,32 @@ class GitterAPI(object):
     def get_gitter_user_rooms(self, user_obj):
         """List the Gitter rooms a user is in.
         """
+        return self.user_rooms_cache.get(user_obj.gitter_access_token,
+                                         self._get_gitter_user_rooms,
+                                         user_obj)
+
+    def _get_gitter_user_rooms(self, user_obj):
         d = self.gitter_request('GET', 'v1/rooms', None,
                                 user=user_obj)
         d.addCallback(assert_http_200)
-        d.addCallback(read_json_response)
-        d.addCallback(self._read_gitter_rooms)
+        d.addCallback(read_json_array, self._read_gitter_room)
+        d.addCallback(lambda (r, c): c)
         return d
 
-    def _read_gitter_rooms(self, (response, content)):
-        return [(room['id'], room['url'][1:])
-                for room in content]
+    def _read_gitter_room(self, room):
+        return room['id'], room['url'][1:]
 
     def get_room(self, gitter_room, **kwargs):
         """Get a Gitter room without joining it.
         """
+        if 'access_token' in kwargs:
+            access_token = kwargs['access_token']
+        else:
+            access_token = kwargs['user'].gitter_access_token
+        return self.room_cache.get((access_token, gitter_room),
+                                   self._get_room, gitter_room, **kwargs)
+
+    def _get_room(self, gitter_room, **kwargs):
         d = self.gitter_request(
             'POST',
             'v1/rooms',
@@ -142,6 +392,7 @@ class GitterAPI(object):
         d.addCallback(assert_http_200)
         d.addCallback(read_json_response)
         d.addCallback(lambda (r, c): c)
+        d.addBoth(self._invalidate_user, user_obj)
         return d
 
     def leave_room(self, user_obj, gitter_room):
@@ -149,6 +400,7 @@ class GitterAPI(object):
         """
         d = self.get_room(gitter_room, user=user_obj)
         d.addCallback(self._leave_room, user_obj)
+        d.addBoth(self._invalidate_user, user_obj)
         return d
 
     def _leave_room(self, room, user_obj):
@@ -157,10 +409,22 @@ class GitterAPI(object):
         user_id = user_obj.gitter_id
         return self.gitter_request(
             'DELETE',
-            'v1/rooms/%s/users/%s' % (room['id'], user_id),
+            'v1/rooms/%s/users/%s',
             None,
+            room['id'],
+            user_id,
             user=user_obj)
 
+    def _invalidate_user(self, result, user_obj):
+        """Forget cached lookups for a user whose rooms have changed.
+        """
+        self._invalidate_token(user_obj.gitter_access_token)
+        return result
+
+    def _invalidate_token(self, access_token):
+        self.user_rooms_cache.invalidate(access_token)
+        self.room_cache.invalidate_matching(lambda k: k[0] == access_token)
+
     def auth_link(self, matrix_user):
         """Get the link a user should visit to authenticate.
         """
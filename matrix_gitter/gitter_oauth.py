@@ -74,8 +74,8 @@ class Redirect(Resource):
             'redirect_uri': '%scallback' % self.api.url,
             'state': state}
         request.redirect(
-            b'https://gitter.im/login/oauth/authorize?%s' % (
-                urllib.urlencode(getargs)))
+            b'%slogin/oauth/authorize?%s' % (
+                self.api.oauth_url, urllib.urlencode(getargs)))
         request.finish()
         return NOT_DONE_YET
 
@@ -104,10 +104,11 @@ class Callback(Resource):
             'grant_type': 'authorization_code'}
         d = http_request(
             'POST',
-            'https://gitter.im/login/oauth/token',
+            '%slogin/oauth/token' % self.api.oauth_url,
             {'content-type': 'application/x-www-form-urlencoded',
              'accept': 'application/json'},
-            FormProducer(postargs))
+            FormProducer(postargs),
+            endpoint='login/oauth/token')
         d.addCallback(read_json_response)
         d.addCallback(self._authorized, user, request)
         d.addErrback(self.error, request, user)
@@ -129,7 +130,8 @@ class Callback(Resource):
         request.finish()
 
     def error(self, err, request, user):
-        log.failure("Error getting access_token for user {user}", err, user)
+        log.failure("Error getting access_token for user {user}", err,
+                    user=user)
         request.setResponseCode(403)
         request.setHeader('content-type', 'text/plain')
         request.write("Error getting access token :(\n")
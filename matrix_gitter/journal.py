@@ -0,0 +1,249 @@
+import json
+import os
+import re
+from twisted.internet import defer, reactor, threads
+from twisted.internet.task import LoopingCall
+from twisted import logger
+
+
+log = logger.Logger()
+
+
+_segment_re = re.compile(r'^([0-9]+)\.log$')
+
+
+class Journal(object):
+    """Append-only journal of the messages that are being delivered.
+
+    Messages are recorded with `add()` before delivery and marked with
+    `done()` afterwards; the ones that were never marked done are returned by
+    `pending()` after a restart, in order.
+
+    Records are written to the file immediately, so they survive the process
+    crashing, but fsync() is only called every `sync_interval` seconds, from a
+    thread, for all the records written in the meantime. Only one such thread
+    runs at a time, so file descriptors are not closed while being synced.
+
+    The journal is a directory of numbered segment files. A new segment is
+    started once the current one is larger than `segment_size`. Segments
+    are deleted once everything in them is done, and every
+    `compact_interval` seconds, the pending records from old segments are
+    copied forward so that those can be deleted as well.
+    """
+    def __init__(self, path, segment_size=4 * 1024 * 1024,
+                 sync_interval=0.1, compact_interval=300):
+        self.path = path
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+
+        # Pending records: id -> (segment, line)
+        self.entries = {}
+        # Number of pending records in each segment
+        self.segments = {}
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._load()
+
+        self.sync_call = None
+        self.sync_lock = defer.DeferredLock()
+        self.closing_fds = []
+        self.compacting = False
+
+        # Open new segment
+        self.fd = None
+        self.segment = max(self.segments) + 1 if self.segments else 0
+        self._open_segment()
+        # Segments whose records were all copied forward before a crash
+        self._drop_segments()
+
+        self.compact_loop = LoopingCall(self.compact)
+        self.compact_loop.start(compact_interval, now=False)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, '%010d.log' % segment)
+
+    def _load(self):
+        segments = []
+        for name in os.listdir(self.path):
+            m = _segment_re.match(name)
+            if m is not None:
+                segments.append(int(m.group(1)))
+        segments.sort()
+
+        next_id = 0
+        for segment in segments:
+            self.segments[segment] = 0
+            with open(self._segment_path(segment), 'rb') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Partially-written record, from a crash
+                        log.warn("Ignoring invalid record in journal segment "
+                                 "{segment}", segment=segment)
+                        continue
+                    if record[0] == 'a':
+                        # Records copied by compact() appear twice if we
+                        # crashed before the old segment was removed
+                        entry = self.entries.get(record[1])
+                        if entry is not None:
+                            self.segments[entry[0]] -= 1
+                        self.entries[record[1]] = segment, line
+                        self.segments[segment] += 1
+                        next_id = max(next_id, record[1] + 1)
+                    elif record[0] == 'd':
+                        entry = self.entries.pop(record[1], None)
+                        if entry is not None:
+                            self.segments[entry[0]] -= 1
+        self.next_id = next_id
+        log.info("Loaded {segments} journal segments, {pending} pending "
+                 "messages",
+                 segments=len(segments), pending=len(self.entries))
+
+    def _open_segment(self):
+        if self.fd is not None:
+            # Closed once the next sync is done
+            self.closing_fds.append(self.fd)
+            self._schedule_sync()
+        self.fd = os.open(self._segment_path(self.segment),
+                          os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self.segments[self.segment] = 0
+        self.segment_bytes = 0
+
+    def pending(self):
+        """Get the records that were never marked done, in order.
+
+        Returns a list of (id, kind, data) tuples.
+        """
+        result = []
+        for id_ in sorted(self.entries):
+            record = json.loads(self.entries[id_][1])
+            result.append((id_, record[2], record[3]))
+        return result
+
+    def add(self, kind, data):
+        """Record a message, returning its id.
+        """
+        id_ = self.next_id
+        self.next_id += 1
+        line = json.dumps(['a', id_, kind, data], separators=(',', ':'))
+        line += '\n'
+        self.entries[id_] = self.segment, line
+        self.segments[self.segment] += 1
+        self._write(line)
+        return id_
+
+    def done(self, id_):
+        """Mark a message as delivered (or given up on).
+        """
+        entry = self.entries.pop(id_, None)
+        if entry is None:
+            return
+        self.segments[entry[0]] -= 1
+        self._write('["d",%d]\n' % id_)
+        self._drop_segments()
+
+    def _write(self, line):
+        os.write(self.fd, line)
+        self.segment_bytes += len(line)
+        if self.segment_bytes >= self.segment_size:
+            self.segment += 1
+            self._open_segment()
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        if self.sync_call is None:
+            self.sync_call = reactor.callLater(self.sync_interval, self._sync)
+
+    def _in_thread(self, fds, close_fds):
+        """Sync and close file descriptors in a thread, after previous syncs.
+        """
+        return self.sync_lock.run(threads.deferToThread,
+                                  _fsync, fds, close_fds)
+
+    def _sync(self):
+        self.sync_call = None
+        if self.sync_lock.locked:
+            # Sync again when the current one is done
+            self._schedule_sync()
+            return
+        fds, self.closing_fds = self.closing_fds, []
+        d = self._in_thread([self.fd] + fds, fds)
+        d.addErrback(lambda err: log.failure("Error syncing journal", err))
+
+    def _drop_segments(self):
+        """Delete the oldest segments as long as they have no pending records.
+
+        Only the oldest segments can be deleted, since the records saying that
+        messages are done have to stay as long as the messages themselves.
+        """
+        if self.compacting:
+            # Old segments go once the copies are synced
+            return
+        for segment in sorted(self.segments):
+            if segment == self.segment or self.segments[segment] > 0:
+                break
+            del self.segments[segment]
+            try:
+                os.remove(self._segment_path(segment))
+            except OSError:
+                log.failure("Error removing journal segment {segment}",
+                            segment=segment)
+
+    def compact(self):
+        """Copy the pending records from old segments forward.
+
+        The old segments will be deleted after the copies have been synced.
+        """
+        old = [s for s in self.segments if s != self.segment]
+        if not old:
+            return
+        moved = 0
+        for id_ in sorted(self.entries):
+            segment, line = self.entries[id_]
+            if segment != self.segment:
+                self.segments[segment] -= 1
+                self.entries[id_] = self.segment, line
+                self.segments[self.segment] += 1
+                os.write(self.fd, line)
+                self.segment_bytes += len(line)
+                moved += 1
+        log.info("Compacting journal: {moved} records moved out of "
+                 "{segments} segments",
+                 moved=moved, segments=len(old))
+        self.compacting = True
+        d = self._in_thread([self.fd], [])
+        d.addBoth(self._compacted)
+
+    def _compacted(self, result):
+        self.compacting = False
+        if result is not None:
+            log.failure("Error compacting journal", result)
+        else:
+            self._drop_segments()
+
+    def close(self):
+        """Sync and close, on shutdown.
+
+        Returns a Deferred that fires once the syncs already running are done
+        and the files are closed.
+        """
+        if self.compact_loop.running:
+            self.compact_loop.stop()
+        if self.sync_call is not None and self.sync_call.active():
+            self.sync_call.cancel()
+        self.sync_call = None
+        fds, self.closing_fds = self.closing_fds, []
+        d = self._in_thread([self.fd] + fds, fds + [self.fd])
+        d.addErrback(lambda err: log.failure("Error closing journal", err))
+        return d
+
+
+def _fsync(fds, close_fds):
+    for fd in fds:
+        os.fsync(fd)
+    for fd in close_fds:
+        os.close(fd)
@@ -1,20 +1,68 @@
+import json
 import os
 import platform
 import sys
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted import logger
 
+from matrix_gitter import flight
+
+
+log = logger.Logger()
+
+
+def json_log_observer(fp):
+    """Log observer writing one JSON object per line, for machines.
+
+    Each line has the time, level, namespace, formatted text and the
+    traceback of failures, plus the event's fields that can be serialized,
+    such as `user` or `room`.
+    """
+    def observer(event):
+        record = {'time': event['log_time'],
+                  'level': event['log_level'].name,
+                  'namespace': event.get('log_namespace'),
+                  'text': logger.formatEvent(event)}
+        for key, value in event.iteritems():
+            if key.startswith('log_') or key in record:
+                continue
+            if isinstance(value, str):
+                value = value.decode('utf-8', 'replace')
+            try:
+                json.dumps(value)
+            except (TypeError, ValueError):
+                continue
+            record[key] = value
+        if 'log_failure' in event:
+            try:
+                record['traceback'] = event['log_failure'].getTraceback()
+            except Exception:
+                record['traceback'] = None
+        fp.write(json.dumps(record) + '\n')
+        fp.flush()
+    return observer
+
 
 def main():
+    config = {}
+    execfile('settings.py', config, config)
+
     # Log to stderr
-    observer = logger.FileLogObserver(sys.stderr,
-                                      logger.formatEventAsClassicLogText)
+    if config.get('log_format', 'text') == 'json':
+        observer = json_log_observer(sys.stderr)
+    else:
+        observer = logger.FileLogObserver(sys.stderr,
+                                          logger.formatEventAsClassicLogText)
     # Filter events by level
     predicate = logger.LogLevelFilterPredicate(logger.LogLevel.warn)
-    predicate.setLogLevelForNamespace('matrix_gitter', logger.LogLevel.info)
+    predicate.setLogLevelForNamespace(
+        'matrix_gitter',
+        logger.LogLevel.levelWithName(config.get('log_level', 'info')))
     observer = logger.FilteringLogObserver(observer, [predicate])
-    # Register as global observer
-    logger.globalLogPublisher.addObserver(observer)
+    # Register as global observers, with the flight recorder that keeps
+    # warnings and errors; this also stops buffering events
+    logger.globalLogBeginner.beginLoggingTo([observer, flight.observe],
+                                            redirectStandardIO=False)
 
     if (platform.system().lower() == 'darwin' and
             not os.environ.get('SSL_CERT_FILE')):
@@ -25,9 +73,16 @@ def main():
             "==========\n\n")
 
     from matrix_gitter.bridge import Bridge
+    from matrix_gitter.markup import warm_up
+    from matrix_gitter.utils import Errback
 
-    config = {}
-    execfile('settings.py', config, config)
     Bridge(config)
 
+    # Get the Markdown converter ready in the background once we are
+    # listening
+    def start_warm_up():
+        d = threads.deferToThread(warm_up)
+        d.addErrback(Errback(log, "Error loading the Markdown converter"))
+    reactor.callWhenRunning(start_warm_up)
+
     reactor.run()
@@ -0,0 +1,71 @@
+from markdown.extensions import Extension
+from markdown.postprocessors import Postprocessor
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import etree
+import re
+
+
+_image_re = re.compile(r'<img(?:\s+[a-zA-Z_-]+="[^"]*")+\s*/?>')
+_image_attr_re = re.compile(r'([a-zA-Z_-]+)="([^"]*)"')
+
+
+def _replace_raw_img(m_img):
+    attrs = dict((m_attr.group(1), m_attr.group(2))
+                 for m_attr in _image_attr_re.finditer(m_img.group(0)))
+    title = ''
+    if 'title' in attrs:
+        title = ' title="%s"' % attrs['title']
+    alt = attrs.get('alt', '').strip()
+    if alt:
+        alt = alt.replace('\\"', '"')
+        alt = alt.replace('<', '&lt;').replace('>', '&gt;')
+        alt = ' (alt: %s)' % alt
+    return u'<a href="{src}"{title}><i>image{alt}</i></a>'.format(
+        src=attrs.get('src', ''),
+        title=title, alt=alt)
+
+
+class ImageLinkTreeprocessor(Treeprocessor):
+    """Replaces inline images with links.
+
+    Riot doesn't allow inline images, only attachments.
+    """
+    def run(self, root):
+        for img in list(root.iter('img')):
+            src = img.get('src', '')
+            title = img.get('title')
+            alt = img.get('alt', '').strip()
+            tail = img.tail
+            # Turn the element into the link in-place
+            img.clear()
+            img.tag = 'a'
+            img.set('href', src)
+            if title is not None:
+                img.set('title', title)
+            etree.SubElement(img, 'i').text = (
+                'image (alt: %s)' % alt if alt else 'image')
+            img.tail = tail
+
+
+class RawImageLinkPostprocessor(Postprocessor):
+    """Replaces images in raw HTML with links.
+
+    Those are not in the element tree, so we have to use a regex :sob:
+    """
+    def run(self, text):
+        blocks = self.markdown.htmlStash.rawHtmlBlocks
+        for index, (html, safe) in enumerate(blocks):
+            if '<img' in html:
+                blocks[index] = _image_re.sub(_replace_raw_img, html), safe
+        return text
+
+
+class ImageLinkExtension(Extension):
+    """Replaces images with links, in both Markdown and raw HTML.
+    """
+    def extendMarkdown(self, md, md_globals):
+        md.treeprocessors.add('image_link', ImageLinkTreeprocessor(md),
+                              '_end')
+        md.postprocessors.add('raw_image_link',
+                              RawImageLinkPostprocessor(md),
+                              '<raw_html')
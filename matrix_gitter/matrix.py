@@ -1,20 +1,45 @@
+from collections import OrderedDict
 from datetime import datetime
-import json
-from twisted.internet import reactor
+import time
+from twisted.internet import defer, reactor
 from twisted.python.failure import Failure
 from twisted import logger
 from twisted.web.resource import Resource, NoResource
 from twisted.web.server import NOT_DONE_YET, Site
 import urllib
 
-from matrix_gitter.markup import gitter_to_matrix
-from matrix_gitter.utils import assert_http_200, Errback, JsonProducer, \
-    read_json_response, http_request
+from matrix_gitter.admin import admin_resource, Metrics
+from matrix_gitter.metrics import Counter, Histogram
+from matrix_gitter.tracing import Trace
+from matrix_gitter.utils import assert_http_200, Errback, JsonArrayDecoder, \
+    JsonProducer, LogSummary, read_json_response, http_request
 
 
 log = logger.Logger()
 
 
+transaction_seconds = Histogram(
+    'matrix_gitter_transaction_seconds',
+    "Time spent processing transactions from the homeserver")
+events_total = Counter(
+    'matrix_gitter_events_total',
+    "Events received from the homeserver",
+    ['type'])
+forward_stage_seconds = Histogram(
+    'matrix_gitter_forward_stage_seconds',
+    "Duration of each request made to forward a message to Matrix",
+    ['stage'])
+forward_seconds = Histogram(
+    'matrix_gitter_forward_seconds',
+    "Total time to forward a message to Matrix, including creating the "
+    "virtual user and joining the room if needed",
+    ['outcome'])
+events_log = LogSummary(
+    log,
+    "Received {total} events from the homeserver in the last {interval} "
+    "seconds: {counts}")
+
+
 HELP_MESSAGE = (
     "This service is entirely controlled through messages sent in private to "
     "this bot. The commands I recognize are:\n"
@@ -72,119 +97,183 @@ class Transaction(BaseMatrixResource):
     """`/transactions/<txid>` endpoint, where the homeserver delivers events.
 
     This reacts to events from Matrix.
+
+    The homeserver sends a transaction again if it didn't get our response,
+    so we remember how many events of the recent transactions we handled and
+    skip those.
     """
     isLeaf = True
 
+    CHUNK_SIZE = 64 * 1024
+    KEEP_TRANSACTIONS = 1000
+
+    def __init__(self, api):
+        BaseMatrixResource.__init__(self, api)
+        # txid -> number of events handled, None once complete
+        self.handled = OrderedDict()
+
     def render_PUT(self, request):
         if len(request.postpath) == 1:
             transaction, = request.postpath
         else:
             raise NoResource
 
-        events = json.load(request.content)['events']
-        for event in events:
-            user = event['user_id']
-            room = event['room_id']
-            log.info("  {user} on {room}",
-                     user=user, room=room)
-            log.info("    {type}", type=event['type'])
-            log.info("    {content}", content=event['content'])
-
-            if (self.api.is_virtualuser(user) or
-                    self.api.is_virtualuser(event.get('state_key'))):
-                pass
-            elif (event['type'] == 'm.room.member' and
-                    event['content'].get('membership') == 'invite' and
-                    event['state_key'] == self.api.bot_fullname):
-                # We've been invited to a room, join it
-                # FIXME: Remember rooms we've left from private_room_members
-                log.info("Joining room {room}", room=room)
+        start = self.transaction_start = time.time()
+
+        skip = self.handled.get(transaction, 0)
+        if skip is None:
+            log.info("Ignoring transaction {txn} sent again",
+                     txn=transaction)
+            return '{}'
+        if transaction not in self.handled:
+            self.handled[transaction] = 0
+            if len(self.handled) > self.KEEP_TRANSACTIONS:
+                self.handled.popitem(last=False)
+        count = [0]
+
+        def event(event):
+            count[0] += 1
+            if count[0] > skip:
+                self.handled[transaction] = count[0]
+                try:
+                    self.handle_event(event)
+                except Exception:
+                    log.failure("Error handling event in transaction {txn}",
+                                txn=transaction)
+
+        # Decode the events one at a time, so that a big transaction doesn't
+        # get loaded in memory all at once (Twisted keeps big request bodies
+        # in a temporary file)
+        decoder = JsonArrayDecoder(event, key='events')
+        request.content.seek(0, 0)
+        try:
+            while True:
+                chunk = request.content.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+            decoder.close()
+        except ValueError as e:
+            log.warn("Invalid transaction {txn} ({events} events handled): "
+                     "{error}",
+                     txn=transaction, events=count[0], error=str(e))
+            request.setResponseCode(400)
+            return '{"errcode": "M_NOT_JSON"}'
+        self.handled[transaction] = None
+
+        transaction_seconds.observe(time.time() - start)
+        return '{}'
+
+    def handle_event(self, event):
+        """Handle a single event from a transaction.
+        """
+        events_total.inc((event['type'],))
+        user = event['user_id']
+        room = event['room_id']
+        events_log.add(event['type'])
+        log.debug("Event {type} from {user} on {room}: {content!r}",
+                  type=event['type'], user=user, room=room,
+                  content=event['content'])
+
+        if (self.api.is_virtualuser(user) or
+                self.api.is_virtualuser(event.get('state_key'))):
+            pass
+        elif (event['type'] == 'm.room.member' and
+                event['content'].get('membership') == 'invite' and
+                event['state_key'] == self.api.bot_fullname):
+            # We've been invited to a room, join it
+            # FIXME: Remember rooms we've left from private_room_members
+            log.info("Joining room {room}", room=room)
+            d = self.matrix_request(
+                'POST',
+                '_matrix/client/r0/join/%s',
+                {},
+                room)
+            d.addErrback(Errback(log, "Error joining room {room}",
+                                 room=room))
+        elif (event['type'] == 'm.room.member' and
+                event['content'].get('membership') == 'join'):
+            # We or someone else joined a room
+            if self.api.get_room(room) is None:
+                # We want to be in private chats with users, but either we
+                # or them may invite; this indicates that the second party
+                # has joined, or that we have joined an empty room.
+                # Request the list of members to find out
                 d = self.matrix_request(
-                    'POST',
-                    '_matrix/client/r0/join/%s',
-                    {},
-                    room)
-                d.addErrback(Errback(log, "Error joining room {room}",
-                                     room=room))
-            elif (event['type'] == 'm.room.member' and
-                    event['content'].get('membership') == 'join'):
-                # We or someone else joined a room
-                if self.api.get_room(room) is None:
-                    # We want to be in private chats with users, but either we
-                    # or them may invite; this indicates that the second party
-                    # has joined, or that we have joined an empty room.
-                    # Request the list of members to find out
+                    'GET',
+                    '_matrix/client/r0/rooms/%s/members',
+                    None,
+                    room,
+                    limit='3')
+                d.addCallback(read_json_response)
+                d.addCallback(self.private_room_members, room)
+                d.addErrback(Errback(
+                    log, "Error getting members of room {room}",
+                    room=room))
+            # We don't care about joins to linked rooms, they have to be
+            # virtual users
+        elif (event['type'] == 'm.room.member' and
+                event['content'].get('membership') != 'join' and
+                event['content'].get('membership') != 'invite'):
+            # Someone left a room
+            room_obj = self.api.get_room(room)
+
+            # It's a linked room: stop forwarding
+            if room_obj is not None:
+                log.info("User {user} left room {room}, destroying",
+                         user=user, room=room)
+                room_obj.destroy()
+            elif user != self.api.bot_fullname:
+                # It is a user's private room
+                user_obj = self.api.get_user(user)
+                if (user_obj is not None and
+                        room == user_obj.matrix_private_room):
+                    log.info("User {user} left his private room {room}, "
+                             "leaving",
+                             user=user, room=room)
+                    self.api.forget_private_room(room)
                     d = self.matrix_request(
-                        'GET',
-                        '_matrix/client/r0/rooms/%s/members',
-                        None,
-                        room,
-                        limit='3')
-                    d.addCallback(read_json_response)
-                    d.addCallback(self.private_room_members, room)
-                    d.addErrback(Errback(
-                        log, "Error getting members of room {room}",
-                        room=room))
-                # We don't care about joins to linked rooms, they have to be
-                # virtual users
-            elif (event['type'] == 'm.room.member' and
-                    event['content'].get('membership') != 'join' and
-                    event['content'].get('membership') != 'invite'):
-                # Someone left a room
+                        'POST',
+                        '_matrix/client/r0/rooms/%s/leave',
+                        {},
+                        room)
+                    d.addCallback(lambda r: self.matrix_request(
+                        'POST',
+                        '_matrix/client/r0/rooms/%s/forget',
+                        {},
+                        room))
+                    d.addErrback(Errback(log, "Error leaving room {room}",
+                                         room=room))
+        elif (event['type'] == 'm.room.message' and
+                event['content'].get('msgtype') == 'm.text'):
+            # Text message to a room
+            if user != self.api.bot_fullname:
                 room_obj = self.api.get_room(room)
+                msg = event['content']['body']
 
-                # It's a linked room: stop forwarding
+                # If it's a linked room: forward
                 if room_obj is not None:
-                    log.info("User {user} left room {room}, destroying",
-                             user=user, room=room)
-                    room_obj.destroy()
-                elif user != self.api.bot_fullname:
-                    # It is a user's private room
+                    if user == room_obj.user.matrix_username:
+                        trace = Trace('to_gitter',
+                                      start=self.transaction_start)
+                        trace.mark('transaction')
+                        html = None
+                        if (event['content'].get('format') ==
+                                'org.matrix.custom.html'):
+                            html = event['content'].get('formatted_body')
+                        room_obj.to_gitter(msg, html, trace)
+                # If it's a message on a private room, handle a command
+                else:
                     user_obj = self.api.get_user(user)
                     if (user_obj is not None and
                             room == user_obj.matrix_private_room):
-                        log.info("User {user} left his private room {room}, "
-                                 "leaving",
-                                 user=user, room=room)
-                        self.api.forget_private_room(room)
-                        d = self.matrix_request(
-                            'POST',
-                            '_matrix/client/r0/rooms/%s/leave',
-                            {},
-                            room)
-                        d.addCallback(lambda r: self.matrix_request(
-                            'POST',
-                            '_matrix/client/r0/rooms/%s/forget',
-                            {},
-                            room))
-                        d.addErrback(Errback(log, "Error leaving room {room}",
-                                             room=room))
-            elif (event['type'] == 'm.room.message' and
-                    event['content'].get('msgtype') == 'm.text'):
-                # Text message to a room
-                if user != self.api.bot_fullname:
-                    room_obj = self.api.get_room(room)
-                    msg = event['content']['body']
-
-                    # If it's a linked room: forward
-                    if room_obj is not None:
-                        if user == room_obj.user.matrix_username:
-                            log.info("Forwarding to Gitter")
-                            room_obj.to_gitter(msg)
-                    # If it's a message on a private room, handle a command
-                    else:
-                        user_obj = self.api.get_user(user)
-                        if (user_obj is not None and
-                                room == user_obj.matrix_private_room):
-                            if user_obj.gitter_access_token is not None:
-                                self.command(user_obj, msg)
-                            else:
-                                self.api.private_message(
-                                    user_obj,
-                                    "You are not logged in.",
-                                    False)
-
-        return '{}'
+                        if user_obj.gitter_access_token is not None:
+                            self.command(user_obj, msg)
+                        else:
+                            self.api.private_message(
+                                user_obj,
+                                "You are not logged in.",
+                                False)
 
     def command(self, user_obj, msg):
         """Handle a command receive from a user in private chat.
@@ -435,7 +524,8 @@ class MatrixAPI(object):
     This communicates with a Matrix homeserver as an application service.
     """
     def __init__(self, bridge, port, homeserver_url, homeserver_domain,
-                 botname, token_as, token_hs, debug=False):
+                 botname, token_as, token_hs, debug=False, bind_address='',
+                 admin_token=None):
         self.bridge = bridge
         self.homeserver_url = homeserver_url
         self.homeserver_domain = homeserver_domain
@@ -467,10 +557,13 @@ class MatrixAPI(object):
         root = Resource()
         root.putChild('transactions', Transaction(self))
         root.putChild('users', Users(self))
+        if admin_token:
+            root.putChild('admin', admin_resource(bridge, admin_token))
+            root.putChild('metrics', Metrics(bridge, admin_token))
         site = Site(root)
         site.displayTracebacks = debug
         site.logRequest = True
-        reactor.listenTCP(port, site)
+        reactor.listenTCP(port, site, interface=bind_address)
 
     def is_virtualuser(self, user):
         if user is None:
@@ -485,6 +578,7 @@ class MatrixAPI(object):
     def matrix_request(self, method, uri, content, *args, **kwargs):
         """Matrix client->homeserver API request.
         """
+        endpoint = uri
         if args:
             uri = uri % tuple(urllib.quote(a) for a in args)
         if isinstance(uri, unicode):
@@ -503,7 +597,8 @@ class MatrixAPI(object):
             uri,
             {'content-type': 'application/json',
              'accept': 'application/json'},
-            JsonProducer(content) if content is not None else None)
+            JsonProducer(content) if content is not None else None,
+            endpoint=endpoint)
         if assert200:
             d.addCallback(assert_http_200)
         return d
@@ -521,12 +616,19 @@ class MatrixAPI(object):
                                  help=HELP_MESSAGE),
                              True)
 
-    def forward_message(self, room, username, msg):
+    def forward_message(self, room, username, msg, html, txn_id=None,
+                        trace=None):
         """Called from the Bridge to send a forwarded message to a room.
 
         Creates the user, invites him on the room, then speaks the message.
+        `html` is the formatted version of `msg`. Sending again with the same
+        `txn_id` won't duplicate the message.
+
+        Returns a Deferred that fires with True once the message is sent, or
+        False if that failed.
         """
-        self.ForwardMessage(self, username, room, msg)
+        return self.ForwardMessage(self, username, room, msg, html,
+                                   txn_id, trace).finished
 
     class ForwardMessage(object):
         """Message forwarding state-machine.
@@ -558,9 +660,12 @@ class MatrixAPI(object):
         #       ^           +-------+ <--------------------+
         #       +-----------+MESSAGE|
         #              fail +-------+
-        def __init__(self, matrix, username, room, message):
+        def __init__(self, matrix, username, room, message, html,
+                     txn_id=None, trace=None):
             self._created = False
             self._joined = False
+            self.finished = defer.Deferred()
+            self.start = time.time()
 
             self.matrix = matrix
             self.username = username
@@ -568,6 +673,9 @@ class MatrixAPI(object):
                 username, self.matrix.homeserver_domain)
             self.room = room
             self.message = message
+            self.html = html
+            self.txn_id = txn_id if txn_id is not None else txid()
+            self.trace = trace
 
             if not self.matrix.bridge.virtualuser_exists(
                             'gitter_%s' % username):
@@ -579,31 +687,47 @@ class MatrixAPI(object):
                     self.send_message()
                 else:
                     self.invite_user()
+            if trace is not None:
+                trace.mark('database')
 
         def fail(self, err):
             log.failure("Error posting message to Matrix room {room}", err,
                         room=self.room)
+            forward_seconds.observe(time.time() - self.start, ('failed',))
+            self.finished.callback(False)
+
+        def _stage(self, d, stage):
+            """Record the duration of a request in the metrics.
+            """
+            d.addBoth(self._stage_done, stage, time.time())
+            return d
+
+        def _stage_done(self, result, stage, start):
+            forward_stage_seconds.observe(time.time() - start, (stage,))
+            if self.trace is not None:
+                self.trace.span(stage, start)
+            return result
 
         def create_user(self, result=None):
             self._created = True
 
             log.info("Creating user {user}", user=self.username)
-            d = self.matrix.matrix_request(
+            d = self._stage(self.matrix.matrix_request(
                 'POST',
                 '_matrix/client/r0/register',
                 {'type': 'm.login.application_service',
                  'username': 'gitter_%s' % self.username},
-                assert200=False)
+                assert200=False), 'register')
             d.addCallbacks(self.set_user_name, self.fail)
 
         def set_user_name(self, result=None):
-            d = self.matrix.matrix_request(
+            d = self._stage(self.matrix.matrix_request(
                 'PUT',
                 '_matrix/client/r0/profile/%s/displayname',
                 {'displayname': "%s (Gitter)" % self.username},
                 self.matrix_user,
                 assert200=False,
-                user_id=self.matrix_user)
+                user_id=self.matrix_user), 'displayname')
             d.addCallbacks(self.user_created, self.fail)
 
         def user_created(self, result=None):
@@ -619,21 +743,21 @@ class MatrixAPI(object):
         def invite_user(self, result=None):
             self._joined = True
 
-            d = self.matrix.matrix_request(
+            d = self._stage(self.matrix.matrix_request(
                 'POST',
                 '_matrix/client/r0/rooms/%s/invite',
                 {'user_id': self.matrix_user},
                 self.room,
-                assert200=False)
+                assert200=False), 'invite')
             d.addCallbacks(self.join_user, self.fail_join)
 
         def join_user(self, result=None):
-            d = self.matrix.matrix_request(
+            d = self._stage(self.matrix.matrix_request(
                 'POST',
                 '_matrix/client/r0/rooms/%s/join',
                 {},
                 self.room,
-                user_id=self.matrix_user)
+                user_id=self.matrix_user), 'join')
             d.addCallbacks(self.user_joined, self.fail_join)
 
         def user_joined(self, result=None):
@@ -649,17 +773,24 @@ class MatrixAPI(object):
                 self.fail(err)
 
         def send_message(self, result=None):
-            d = self.matrix.matrix_request(
+            content = {'msgtype': 'm.text',
+                       'body': self.message}
+            # Only send HTML if there is formatting
+            if self.html != self.message:
+                content['format'] = 'org.matrix.custom.html'
+                content['formatted_body'] = self.html
+            d = self._stage(self.matrix.matrix_request(
                 'PUT',
                 '_matrix/client/r0/rooms/%s/send/m.room.message/%s',
-                {'msgtype': 'm.text',
-                 'body': self.message,
-                 'format': 'org.matrix.custom.html',
-                 'formatted_body': gitter_to_matrix(self.message)},
+                content,
                 self.room,
-                txid(),
-                user_id=self.matrix_user)
-            d.addErrback(self.fail_message)
+                self.txn_id,
+                user_id=self.matrix_user), 'send')
+            d.addCallbacks(self.sent, self.fail_message)
+
+        def sent(self, result=None):
+            forward_seconds.observe(time.time() - self.start, ('sent',))
+            self.finished.callback(True)
 
     def private_message(self, user_obj, msg, invite):
         """Send a message to a user on the appropriate private room.
@@ -0,0 +1,183 @@
+import bisect
+import os
+import sqlite3
+import time
+
+
+registry = []
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n').encode('utf-8'))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(pairs)
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    elif isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    else:
+        return str(value)
+
+
+class Metric(object):
+    """Base class for metrics.
+
+    Values are kept per tuple of label values, in the order of `labels`.
+
+    If `function` is given, it is called when the metrics are collected and
+    should return a dictionary mapping label tuples to values; this is useful
+    to export state that is kept elsewhere.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self.values = {}
+        registry.append(self)
+
+    def get_values(self):
+        if self.function is not None:
+            return self.function()
+        return self.values
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.type))
+        for labels, value in sorted(self.get_values().iteritems()):
+            lines.append('%s%s %s' % (
+                self.name,
+                _format_labels(self.label_names, labels),
+                _format_value(value)))
+
+
+class Counter(Metric):
+    """A value that only goes up.
+    """
+    type = 'counter'
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    """A value that can go up and down.
+    """
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def dec(self, labels=(), value=1):
+        self.values[labels] = self.values.get(labels, 0) - value
+
+
+class Histogram(Metric):
+    """Distribution of values, such as durations, counted in buckets.
+    """
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                       1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.type))
+        bounds = [_format_value(b) for b in self.buckets] + ['+Inf']
+        for labels, (counts, total) in sorted(self.values.iteritems()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name,
+                    _format_labels(self.label_names, labels,
+                                   'le="%s"' % bound),
+                    cumulative))
+            labels = _format_labels(self.label_names, labels)
+            lines.append('%s_sum%s %s' % (self.name, labels, repr(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+
+
+def render():
+    """Render all the metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in registry:
+        metric.render(lines)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+sqlite_query_seconds = Histogram(
+    'matrix_gitter_sqlite_query_seconds',
+    "Time spent executing SQLite statements",
+    ['statement'])
+
+
+class TimedConnection(sqlite3.Connection):
+    """SQLite connection recording the time spent executing statements.
+
+    Use with `sqlite3.connect(path, factory=TimedConnection)`.
+    """
+    def execute(self, sql, *args):
+        start = time.time()
+        try:
+            return sqlite3.Connection.execute(self, sql, *args)
+        finally:
+            sqlite_query_seconds.observe(
+                time.time() - start,
+                (sql.split(None, 1)[0].upper(),))
+
+
+def _process_memory():
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return {}
+    return {(): pages * os.sysconf('SC_PAGE_SIZE')}
+
+
+def _process_fds():
+    try:
+        return {(): len(os.listdir('/proc/self/fd'))}
+    except OSError:
+        return {}
+
+
+# Only available on Linux
+Gauge('process_resident_memory_bytes',
+      "Resident memory size in bytes",
+      function=_process_memory)
+Gauge('process_open_fds',
+      "Number of open file descriptors, including sockets",
+      function=_process_fds)
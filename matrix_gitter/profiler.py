@@ -0,0 +1,213 @@
+import os
+import signal
+import sys
+import thread
+import threading
+import time
+import traceback
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from twisted import logger
+
+from matrix_gitter.metrics import Counter, Histogram
+
+
+log = logger.Logger()
+
+
+reactor_lag_seconds = Histogram(
+    'matrix_gitter_reactor_lag_seconds',
+    "How late the reactor runs timed calls",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+             2.5, 5.0, 10.0))
+reactor_stalls_total = Counter(
+    'matrix_gitter_reactor_stalls_total',
+    "Times the reactor was blocked for longer than the threshold")
+
+
+class ProfilerBusy(Exception):
+    """A profile is already being recorded.
+    """
+
+
+class Profiler(object):
+    """Statistical profiler for the reactor thread.
+
+    While a profile is running, a separate thread looks at the stack of the
+    reactor thread every `interval` seconds and counts the stacks it sees.
+    The result is written in the "collapsed" format used by flamegraph.pl
+    and speedscope: one line per distinct stack, frames separated by
+    semicolons, followed by the number of samples.
+
+    Nothing runs between profiles, so this costs nothing when not in use.
+    """
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self.running = None
+
+    def start(self, duration=30, interval=0.005):
+        """Profile the reactor thread for `duration` seconds.
+
+        Must be called from the reactor thread. Returns a Deferred that fires
+        with the name of the written file and its content, or fails with
+        `ProfilerBusy` if a profile is already running.
+        """
+        if self.running is not None:
+            return defer.fail(ProfilerBusy())
+        log.info("Profiling the reactor thread for {duration} seconds",
+                 duration=duration)
+        d = self.running = defer.Deferred()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(thread.get_ident(), duration, interval),
+            name='profiler')
+        sampler.daemon = True
+        sampler.start()
+        return d
+
+    def _sample(self, thread_id, duration, interval):
+        # Runs in the sampling thread
+        try:
+            counts, samples = self._collect(thread_id, duration, interval)
+        except Exception:
+            # Report it, else we'd stay busy forever
+            reactor.callFromThread(self._failed, Failure())
+        else:
+            reactor.callFromThread(self._done, counts, samples)
+
+    def _collect(self, thread_id, duration, interval):
+        counts = {}
+        samples = 0
+        end = time.time() + duration
+        while time.time() < end:
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append('%s:%s' % (
+                    frame.f_globals.get('__name__', '?'),
+                    frame.f_code.co_name))
+                frame = frame.f_back
+            del frame
+            if stack:
+                stack.reverse()
+                key = ';'.join(stack)
+                counts[key] = counts.get(key, 0) + 1
+                samples += 1
+            time.sleep(interval)
+        return counts, samples
+
+    def _failed(self, err):
+        d, self.running = self.running, None
+        d.errback(err)
+
+    def _done(self, counts, samples):
+        d, self.running = self.running, None
+        content = ''.join('%s %d\n' % (stack, count)
+                          for stack, count in sorted(counts.iteritems()))
+        filename = os.path.join(
+            self.directory,
+            time.strftime('profile-%Y%m%d-%H%M%S.txt'))
+        try:
+            with open(filename, 'wb') as fp:
+                fp.write(content)
+        except IOError:
+            log.failure("Error writing profile to {file}", file=filename)
+            filename = None
+        else:
+            log.info("Wrote profile to {file} ({samples} samples)",
+                     file=filename, samples=samples)
+        d.callback((filename, content))
+
+    def install_signal(self, signum=getattr(signal, 'SIGUSR1', None)):
+        """Start a profile with the default settings when sent a signal.
+
+        The default signal is SIGUSR1; it is not available on Windows.
+        """
+        if signum is None:
+            return
+
+        def handler(signum, frame):
+            reactor.callFromThread(self._from_signal)
+        signal.signal(signum, handler)
+
+    def _from_signal(self):
+        d = self.start()
+        d.addErrback(self._signal_failed)
+
+    def _signal_failed(self, err):
+        if err.check(ProfilerBusy):
+            log.warn("A profile is already running, ignoring signal")
+        else:
+            log.failure("Error profiling", err)
+
+
+class LagMonitor(object):
+    """Measures how late the reactor runs timed calls.
+
+    A call is scheduled every `interval` seconds, and how late it runs is
+    recorded in a histogram. This is how long anything else that was due
+    had to wait, because something was running on the reactor thread.
+
+    If `threshold` is set, a watchdog thread also checks that those calls
+    happen. When one is late by more than `threshold` seconds, it captures
+    the stack of the reactor thread, which is the code blocking it; that is
+    logged once the reactor runs again.
+    """
+    def __init__(self, interval=0.5, threshold=1.0):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalled = False
+        self.stopping = threading.Event()
+        self.call = None
+        reactor.callWhenRunning(self.start)
+
+    def start(self):
+        self.thread_id = thread.get_ident()
+        self.expected = time.time() + self.interval
+        self.call = reactor.callLater(self.interval, self._tick)
+        if self.threshold:
+            watchdog = threading.Thread(target=self._watch,
+                                        name='lag-watchdog')
+            watchdog.daemon = True
+            watchdog.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def _tick(self):
+        now = time.time()
+        lag = max(0.0, now - self.expected)
+        reactor_lag_seconds.observe(lag)
+        if self.stalled:
+            self.stalled = False
+            log.warn("Reactor was blocked for {lag:.3f} seconds", lag=lag)
+        self.expected = now + self.interval
+        self.call = reactor.callLater(self.interval, self._tick)
+
+    def _watch(self):
+        # Runs in the watchdog thread
+        while not self.stopping.wait(self.threshold / 2.0):
+            expected = self.expected
+            if self.stalled or time.time() - expected <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            del frame
+            if self.expected != expected:
+                # The reactor caught up while we were looking
+                continue
+            self.stalled = True
+            # Logged once the reactor is free, log observers aren't
+            # thread-safe; this runs before _tick()
+            reactor.callFromThread(self._report_stall, stack)
+
+    def _report_stall(self, stack):
+        reactor_stalls_total.inc()
+        log.warn("Reactor blocked for more than {threshold} seconds, it was "
+                 "running:\n{stack}",
+                 threshold=self.threshold, stack=stack)
+
+    def stop(self):
+        self.stopping.set()
+        if self.call.active():
+            self.call.cancel()
@@ -0,0 +1,129 @@
+import itertools
+import json
+import os
+import random
+import time
+from twisted import logger
+
+from matrix_gitter import flight
+from matrix_gitter.metrics import Histogram
+
+
+log = logger.Logger()
+
+
+stage_seconds = Histogram(
+    'matrix_gitter_trace_stage_seconds',
+    "Time messages spend in each stage of forwarding",
+    ['direction', 'stage'])
+total_seconds = Histogram(
+    'matrix_gitter_trace_seconds',
+    "Time from receiving a message to delivering it",
+    ['direction', 'outcome'])
+
+
+# Messages taking longer than this are recorded by the flight recorder
+SLOW_THRESHOLD = 5.0
+
+_sample_rate = 0.0
+_writer = None
+_trace_ids = itertools.count(1)
+
+
+def configure(sample_rate, path):
+    """Set the proportion of traces to write to a file.
+
+    The file uses the Chrome trace event format, which can be opened in
+    chrome://tracing or Perfetto; each message is shown as its own thread.
+    """
+    global _sample_rate, _writer
+    _sample_rate = sample_rate
+    if sample_rate > 0 and _writer is None:
+        _writer = _TraceWriter(path)
+        log.info("Writing {rate:.1%} of message traces to {path}",
+                 rate=sample_rate, path=path)
+
+
+class Trace(object):
+    """Follows a message through the bridge, timing each stage.
+
+    Stages are timed either with `mark()`, that records the time since the
+    previous mark, or with `span()` for explicit start and end times. The
+    durations go into histograms; sampled traces are also written to the
+    trace file once finished. Messages slower than `SLOW_THRESHOLD` are
+    recorded by the flight recorder, with their slowest stage.
+    """
+    __slots__ = ('direction', 'start', 'last', 'spans', 'slowest',
+                 'slowest_seconds')
+
+    def __init__(self, direction, start=None):
+        self.direction = direction
+        self.start = self.last = start if start is not None else time.time()
+        self.slowest = None
+        self.slowest_seconds = 0.0
+        if _writer is not None and random.random() < _sample_rate:
+            self.spans = []
+        else:
+            self.spans = None
+
+    def mark(self, stage):
+        """Record the time since the previous mark as `stage`.
+        """
+        now = time.time()
+        self.span(stage, self.last, now)
+        self.last = now
+
+    def span(self, stage, start, end=None):
+        """Record a stage with explicit times.
+        """
+        if end is None:
+            end = time.time()
+        duration = end - start
+        stage_seconds.observe(duration, (self.direction, stage))
+        if duration > self.slowest_seconds:
+            self.slowest, self.slowest_seconds = stage, duration
+        if self.spans is not None:
+            self.spans.append((stage, start, end))
+
+    def finish(self, outcome):
+        """Record the total time, and write the trace out if sampled.
+        """
+        now = time.time()
+        total = now - self.start
+        total_seconds.observe(total, (self.direction, outcome))
+        if total > SLOW_THRESHOLD:
+            flight.record('slow_message', direction=self.direction,
+                          outcome=outcome, seconds=round(total, 3),
+                          slowest_stage=self.slowest,
+                          slowest_seconds=round(self.slowest_seconds, 3))
+        if self.spans is not None:
+            self.spans.append((outcome, self.start, now))
+            _writer.write(self)
+            self.spans = None
+
+
+class _TraceWriter(object):
+    """Writes traces to a file in the Chrome trace event format.
+
+    The array is never closed, which that format allows, so that we can keep
+    appending.
+    """
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.fp = open(path, 'ab')
+        if new:
+            self.fp.write('[\n')
+
+    def write(self, trace):
+        tid = next(_trace_ids)
+        try:
+            for name, start, end in trace.spans:
+                self.fp.write(json.dumps({
+                    'name': name, 'cat': trace.direction, 'ph': 'X',
+                    'ts': int(start * 1000000),
+                    'dur': int((end - start) * 1000000),
+                    'pid': 1, 'tid': tid}))
+                self.fp.write(',\n')
+            self.fp.flush()
+        except IOError:
+            log.failure("Error writing trace")
@@ -1,27 +1,394 @@
 import json
-from StringIO import StringIO
+import math
+import re
 import time
 from twisted.web.iweb import IBodyProducer
 from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectError
+from twisted.internet.interfaces import IProtocol
 from twisted.internet.protocol import connectionDone, Protocol
+from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
 from twisted import logger
-from twisted.web.client import Agent
+from twisted.web.client import Agent, ContentDecoderAgent, GzipDecoder, \
+    RequestNotSent, ResponseFailed
 from twisted.web.http_headers import Headers
 import urllib
+import urlparse
+import zlib
 from zope.interface import implements
 
+from matrix_gitter import flight
+from matrix_gitter.metrics import Counter, Gauge, Histogram
+
+
+log = logger.Logger()
+
+
+class DeflateDecoder(GzipDecoder):
+    """A wrapper for a response with a 'deflate' encoded body.
+    """
+    def deliverBody(self, protocol):
+        self.original.deliverBody(_DeflateProtocol(protocol, self.original))
+
+
+class _DeflateProtocol(proxyForInterface(IProtocol)):
+    """Decompresses 'deflate' data, with or without the zlib header.
+
+    The HTTP spec says it's zlib-wrapped but some servers send raw deflate.
+
+    Data is decompressed `chunk_size` bytes at a time, so a small compressed
+    body can't make us allocate a huge string at once.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, protocol, response):
+        self.original = protocol
+        self._response = response
+        self._decompress = None
+        self._header = b''
+
+    def dataReceived(self, data):
+        if self._decompress is None:
+            # Wait for the 2 bytes of the zlib header, if there is one
+            self._header += data
+            if len(self._header) < 2:
+                return
+            data, self._header = self._header, b''
+            # Check the zlib header: compression method and checksum
+            if (ord(data[0]) & 0x0F == 8 and
+                    (ord(data[0]) * 256 + ord(data[1])) % 31 == 0):
+                self._decompress = zlib.decompressobj()
+            else:
+                self._decompress = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            while data:
+                raw = self._decompress.decompress(data, self.chunk_size)
+                data = self._decompress.unconsumed_tail
+                if raw:
+                    self.original.dataReceived(raw)
+        except zlib.error:
+            raise ResponseFailed([Failure()], self._response)
+
+    def connectionLost(self, reason):
+        # Errors are passed on rather than raised, else the wrapped protocol
+        # would never be told the body is over
+        if self._header:
+            # Body shorter than the header, can't be valid
+            self.original.connectionLost(Failure(
+                ResponseFailed([reason], self._response)))
+            return
+        if self._decompress is not None:
+            try:
+                raw = self._decompress.flush()
+            except zlib.error:
+                self.original.connectionLost(Failure(
+                    ResponseFailed([reason, Failure()], self._response)))
+                return
+            if raw:
+                self.original.dataReceived(raw)
+        self.original.connectionLost(reason)
+
 
 agent = Agent(reactor)
+decoding_agent = ContentDecoderAgent(agent, [('gzip', GzipDecoder),
+                                             ('deflate', DeflateDecoder)])
+
+
+class TimerWheel(object):
+    """Hashed timing wheel, for timers that don't need to be precise.
+
+    Timers are put in one of `size` slots according to the tick they expire
+    on; a single delayed call on the reactor advances the wheel every `tick`
+    seconds while there are timers. Scheduling and cancelling are O(1),
+    whereas the reactor keeps its delayed calls in a heap.
+
+    Timers fire up to one tick late, never early.
+    """
+    def __init__(self, tick=0.1, size=512):
+        self.tick = tick
+        self.size = size
+        self.slots = [set() for i in xrange(size)]
+        self.current = int(time.time() / tick)
+        self.count = 0
+        self.call = None
+        self.advancing = False
+
+    def call_later(self, delay, function, *args, **kwargs):
+        """Call a function later, like `reactor.callLater()`.
+
+        Returns an object with `active()` and `cancel()` methods.
+        """
+        if (self.count == 0 and self.call is None and
+                not self.advancing):
+            self.current = int(time.time() / self.tick)
+        target = int(math.ceil((time.time() + delay) / self.tick))
+        target = max(target, self.current + 1)
+        timer = _WheelTimer(self, target, function, args, kwargs)
+        self.slots[target % self.size].add(timer)
+        self.count += 1
+        # While advancing, _advance() reschedules itself once it is done
+        if self.call is None and not self.advancing:
+            self._schedule()
+        return timer
+
+    def _schedule(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = reactor.callLater(
+            max(0, (self.current + 1) * self.tick - time.time()),
+            self._advance)
+
+    def _advance(self):
+        self.call = None
+        self.advancing = True
+        try:
+            now = int(time.time() / self.tick)
+            while self.current < now and self.count:
+                self.current += 1
+                slot = self.slots[self.current % self.size]
+                expired = [t for t in slot if t.target <= self.current]
+                for timer in expired:
+                    slot.discard(timer)
+                    self.count -= 1
+                    timer.wheel = None
+                for timer in expired:
+                    try:
+                        timer.function(*timer.args, **timer.kwargs)
+                    except Exception:
+                        log.failure("Error in timer")
+        finally:
+            self.advancing = False
+        if self.count:
+            self.current = min(self.current, now)
+            self._schedule()
+
+
+class _WheelTimer(object):
+    __slots__ = ('wheel', 'target', 'function', 'args', 'kwargs')
+
+    def __init__(self, wheel, target, function, args, kwargs):
+        self.wheel = wheel
+        self.target = target
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def active(self):
+        return self.wheel is not None
+
+    def cancel(self):
+        wheel = self.wheel
+        if wheel is not None:
+            wheel.slots[self.target % wheel.size].discard(self)
+            wheel.count -= 1
+            self.wheel = None
+
+
+timer_wheel = TimerWheel()
+
+
+class CircuitOpenError(IOError):
+    """A request was not made because its upstream host is failing.
+    """
+
+
+class CircuitBreaker(object):
+    """Stops sending requests to an upstream host that is failing.
+
+    The outcome of the last `window` requests is kept. If at least
+    `min_requests` were made and the proportion of errors (or of requests
+    slower than `slow_threshold` seconds) reaches `threshold`, the circuit
+    opens: requests fail immediately with CircuitOpenError.
+
+    After `open_time` seconds, the circuit becomes half-open: a single probe
+    request is let through. If it succeeds, the circuit closes again, else it
+    stays open twice as long (up to `max_open_time`).
+
+    Each change of state starts a new generation; requests are tagged with
+    the generation they were made in, and outcomes from an earlier one are
+    ignored, so that a request made before the circuit opened can't be
+    taken for the probe.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, window=20, min_requests=10, threshold=0.5,
+                 slow_threshold=10, open_time=5, max_open_time=5 * 60):
+        self.logger = logger.Logger('%s.CircuitBreaker.%s' % (__name__, name))
+        self.name = name
+        self.window = window
+        self.min_requests = min_requests
+        self.threshold = threshold
+        self.slow_threshold = slow_threshold
+        self.min_open_time = open_time
+        self.max_open_time = max_open_time
+
+        self.state = self.CLOSED
+        self.outcomes = []
+        self.open_time = open_time
+        self.open_until = None
+        self.probing = False
+        self.generation = 0
 
+        # Counters
+        self.trips = 0
+        self.rejected = 0
 
-def http_request(method, uri, headers, bodyProducer=None, timeout=40):
-    d = agent.request(method, uri,
-                      Headers(dict((k, [v]) for k, v in headers.iteritems())),
-                      bodyProducer)
+    def allow(self):
+        """Whether a request can be made now.
+
+        Returns None if not, else the generation to pass to `record()` with
+        the outcome, which has to be called.
+        """
+        if self.state == self.OPEN:
+            if time.time() < self.open_until:
+                self.rejected += 1
+                return None
+            self._set_state(self.HALF_OPEN)
+            self.logger.info("Circuit half-open, probing")
+        if self.state == self.HALF_OPEN:
+            if self.probing:
+                self.rejected += 1
+                return None
+            self.probing = True
+        return self.generation
+
+    def record(self, generation, success, duration):
+        """Record the outcome of a request.
+        """
+        if generation != self.generation:
+            # Request made before the last change of state
+            return
+        if self.state == self.HALF_OPEN:
+            self.probing = False
+            if success and duration < self.slow_threshold:
+                self._set_state(self.CLOSED)
+                self.outcomes = []
+                self.open_time = self.min_open_time
+                self.logger.info("Circuit closed")
+            else:
+                self.open_time = min(self.open_time * 2, self.max_open_time)
+                self._open("probe failed")
+            return
+
+        self.outcomes.append(success and duration < self.slow_threshold)
+        if len(self.outcomes) > self.window:
+            del self.outcomes[0]
+        if len(self.outcomes) >= self.min_requests:
+            failed = self.outcomes.count(False)
+            if failed >= self.threshold * len(self.outcomes):
+                self._open("%d of the last %d requests failed or were slow"
+                           % (failed, len(self.outcomes)))
+
+    def _set_state(self, state, **fields):
+        self.state = state
+        self.generation += 1
+        flight.record('circuit', host=self.name, state=state, **fields)
+
+    def _open(self, reason):
+        self._set_state(self.OPEN, reason=reason)
+        self.open_until = time.time() + self.open_time
+        self.trips += 1
+        self.logger.warn("Circuit open for {delay}s: {reason}",
+                         delay=self.open_time, reason=reason)
+
+
+circuit_breakers = {}
+
+Gauge('matrix_gitter_circuit_breaker_open',
+      "Whether requests to an upstream host are being rejected (0: closed, "
+      "0.5: half-open, 1: open)",
+      ['host'],
+      function=lambda: dict(
+          ((b.name,), {CircuitBreaker.CLOSED: 0,
+                       CircuitBreaker.HALF_OPEN: 0.5,
+                       CircuitBreaker.OPEN: 1}[b.state])
+          for b in circuit_breakers.itervalues()))
+Counter('matrix_gitter_circuit_breaker_trips_total',
+        "Number of times the circuit to an upstream host opened",
+        ['host'],
+        function=lambda: dict(((b.name,), b.trips)
+                              for b in circuit_breakers.itervalues()))
+Counter('matrix_gitter_circuit_breaker_rejected_total',
+        "Requests that failed fast because of an open circuit",
+        ['host'],
+        function=lambda: dict(((b.name,), b.rejected)
+                              for b in circuit_breakers.itervalues()))
+
+http_request_seconds = Histogram(
+    'matrix_gitter_http_request_seconds',
+    "Time until the response headers of HTTP requests to upstream servers",
+    ['host', 'endpoint', 'method', 'status'])
+
+
+def get_circuit_breaker(uri):
+    """Get the circuit breaker for the host of a URI.
+    """
+    uri = urlparse.urlparse(uri)
+    name = '%s://%s' % (uri.scheme, uri.netloc)
+    try:
+        return circuit_breakers[name]
+    except KeyError:
+        breaker = circuit_breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+def http_request(method, uri, headers, bodyProducer=None, timeout=40,
+                 compress=True, endpoint=None):
+    """Make an HTTP request.
+
+    Unless `compress` is False, the response can be gzip or deflate-encoded,
+    it is decompressed transparently. Don't use it for streams, as the server
+    might hold data until it has enough to compress.
+
+    `endpoint` is used to group the requests in the metrics; it should be the
+    URI without the variable parts.
+
+    If the host is failing, this fails right away with CircuitOpenError.
+    """
+    breaker = get_circuit_breaker(uri)
+    generation = breaker.allow()
+    if generation is None:
+        flight.record('http_rejected', host=breaker.name, endpoint=endpoint)
+        return defer.fail(CircuitOpenError(
+            "Not sending request to %s, it is failing" % breaker.name))
+
+    if compress:
+        request_agent = decoding_agent
+    else:
+        request_agent = agent
+    start = time.time()
+    d = request_agent.request(
+        method, uri,
+        Headers(dict((k, [v]) for k, v in headers.iteritems())),
+        bodyProducer)
+
+    def record(result):
+        duration = time.time() - start
+        if isinstance(result, Failure):
+            success = False
+            status = 'error'
+            flight.record('http', method=method, host=breaker.name,
+                          endpoint=endpoint, error=result.type.__name__,
+                          seconds=round(duration, 3))
+        else:
+            success = result.code < 500
+            status = '%dxx' % (result.code // 100)
+            flight.record('http', method=method, host=breaker.name,
+                          endpoint=endpoint, code=result.code,
+                          seconds=round(duration, 3))
+        breaker.record(generation, success, duration)
+        http_request_seconds.observe(
+            duration,
+            (breaker.name, endpoint or '', method, status))
+        return result
+    d.addBoth(record)
 
     if timeout is not None:
         # http://stackoverflow.com/a/15142570/711380
-        timeoutCall = reactor.callLater(timeout, d.cancel)
+        timeoutCall = timer_wheel.call_later(timeout, d.cancel)
 
         def completed(passthrough):
             if timeoutCall.active():
@@ -40,6 +407,35 @@ def Errback(log, fmt, **kwargs):
     return errback_func
 
 
+class LogSummary(object):
+    """Counts frequent events to log a summary instead of each of them.
+
+    `add()` is cheap; at most every `interval` seconds, a single event is
+    logged with the fields `total`, `interval` and `counts` (a dictionary of
+    the number of events for each key).
+    """
+    def __init__(self, log, fmt, interval=60):
+        self.log = log
+        self.fmt = fmt
+        self.interval = interval
+        self.counts = {}
+        self.call = None
+
+    def add(self, key=None):
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self.call is None:
+            self.call = reactor.callLater(self.interval, self.flush)
+
+    def flush(self):
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.call = None
+        counts, self.counts = self.counts, {}
+        if counts:
+            self.log.info(self.fmt, total=sum(counts.itervalues()),
+                          interval=self.interval, counts=counts)
+
+
 class StringProducer(object):
     """A producer that simply sends a given string.
     """
@@ -74,27 +470,259 @@ class FormProducer(StringProducer):
         StringProducer.__init__(self, urllib.urlencode(body))
 
 
+class ResponseBudget(object):
+    """Limits the memory used by all the responses being received.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def fits(self, size):
+        return self.used + size <= self.limit
+
+
+response_budget = ResponseBudget(64 * 1024 * 1024)
+
+
 class StringReceiver(Protocol):
     """A receiver that buffers up data and emits it on a Deferred when done.
     """
     def __init__(self, response, finished, max_size=2 * 1024 * 1024):
         self.response = response
         self.finished = finished
-        self.remaining = max_size
-        self.content = StringIO()
+        self.max_size = max_size
+        self.size = 0
+        self.held = 0
+        self.content = []
 
     def dataReceived(self, bytes):
-        if self.remaining:
-            if len(bytes) > self.remaining:
-                self.finished.errback(RuntimeError("response is too big"))
-                self.response.close()
-                return
-            self.content.write(bytes)
-            self.remaining -= len(bytes)
+        if self.finished.called:
+            return
+        self.size += len(bytes)
+        if self.size > self.max_size:
+            self.fail(RuntimeError("response is too big"))
+        elif not response_budget.fits(len(bytes)):
+            self.fail(RuntimeError("too many responses being received"))
+        else:
+            self.received(bytes)
+
+    def received(self, bytes):
+        self.content.append(bytes)
+        self.set_held(self.held + len(bytes))
+
+    def set_held(self, size):
+        """Update the amount of memory this response is using.
+        """
+        response_budget.used += size - self.held
+        self.held = size
+
+    def fail(self, err):
+        self.set_held(0)
+        self.content = []
+        self.finished.errback(err)
+        self.transport.stopProducing()
 
     def connectionLost(self, reason=connectionDone):
         if not self.finished.called:
-            self.finished.callback(self.content.getvalue())
+            content = ''.join(self.content)
+            self.content = []
+            self.set_held(0)
+            self.finished.callback(content)
+
+
+_json_decoder = json.JSONDecoder()
+_json_space_re = re.compile(r'\s*')
+_json_colon_re = re.compile(r'\s*:')
+
+
+class JsonArrayDecoder(object):
+    """Decodes the elements of a JSON array incrementally.
+
+    Feed it data as it comes in; `callback` is called with each element as
+    soon as it is complete. Only the data of the current element is kept.
+
+    If `key` is given, the document is an object and the array is the value
+    for that key; other values are skipped.
+    """
+    def __init__(self, callback, key=None):
+        self.callback = callback
+        self.key = key
+        self.state = 'object' if key is not None else 'array_start'
+        # Whether we are after a value (expecting a comma or the end of the
+        # container), or after a comma (expecting a value)
+        self.after_value = False
+        self.after_comma = False
+        # Data not decoded yet, as a list of chunks, and its total size
+        self.pending = []
+        self.size = 0
+        # Size at which to try decoding again, doubled when it fails so that
+        # big elements don't get decoded over and over
+        self.retry_size = 0
+
+    def feed(self, data):
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= self.retry_size:
+            self._decode(False)
+
+    def close(self):
+        self._decode(True)
+        if self.state != 'end':
+            raise ValueError("truncated JSON document")
+
+    def _decode_value(self, data, pos, final):
+        """Decode a value, returning the end position or None if incomplete.
+        """
+        try:
+            value, end = _json_decoder.raw_decode(data, pos)
+        except ValueError:
+            end = None
+        # Values have to be followed by a separator, else it might be a number
+        # that got cut (decoding "-2.5" as "-2"): wait for more
+        if (end is None or
+                (end == len(data) and not final) or
+                (end < len(data) and data[end] not in ' \t\r\n,:]}')):
+            if final:
+                raise ValueError("invalid JSON document")
+            return None, None
+        return value, end
+
+    def _separator(self, char, closing):
+        """Handle a comma or closing bracket in a container.
+
+        Returns True if `char` is the end of the container.
+        """
+        if char == closing:
+            if self.after_comma:
+                raise ValueError("trailing comma in JSON document")
+        elif char == ',':
+            if not self.after_value:
+                raise ValueError("unexpected comma in JSON document")
+            self.after_value = False
+            self.after_comma = True
+            return False
+        elif self.after_value:
+            raise ValueError("missing comma in JSON document")
+        else:
+            return None
+        self.after_value = self.after_comma = False
+        return True
+
+    def _value_done(self):
+        self.after_value = True
+        self.after_comma = False
+
+    def _decode(self, final):
+        data = ''.join(self.pending)
+        pos = 0
+        while True:
+            pos = _json_space_re.match(data, pos).end()
+            if pos == len(data):
+                break
+            char = data[pos]
+            if self.state == 'end':
+                raise ValueError("data after end of JSON document")
+            elif self.state == 'object':
+                if char != '{':
+                    raise ValueError("JSON document is not an object")
+                self.state = 'object_key'
+                pos += 1
+            elif self.state == 'array_start':
+                if char != '[':
+                    raise ValueError("JSON value is not an array")
+                self.state = 'array'
+                self.after_value = self.after_comma = False
+                pos += 1
+            elif self.state == 'array':
+                end_of_array = self._separator(char, ']')
+                if end_of_array is not None:
+                    pos += 1
+                    if end_of_array:
+                        if self.key is None:
+                            self.state = 'end'
+                        else:
+                            self.state = 'object_key'
+                            self._value_done()
+                    continue
+                element, end = self._decode_value(data, pos, final)
+                if end is None:
+                    break
+                pos = end
+                self._value_done()
+                self.callback(element)
+            else:  # object_key
+                end_of_object = self._separator(char, '}')
+                if end_of_object is not None:
+                    pos += 1
+                    if end_of_object:
+                        self.state = 'end'
+                    continue
+                # Read the key, the colon, and the value if we skip it; if we
+                # don't have all of it yet, wait for more
+                key, end = self._decode_value(data, pos, final)
+                m_colon = end is not None and _json_colon_re.match(data, end)
+                if not m_colon:
+                    if final:
+                        raise ValueError("invalid JSON document")
+                    break
+                if not isinstance(key, basestring):
+                    raise ValueError("JSON object key is not a string")
+                if key == self.key:
+                    self.state = 'array_start'
+                    pos = m_colon.end()
+                else:
+                    value_pos = _json_space_re.match(data,
+                                                     m_colon.end()).end()
+                    value, end = self._decode_value(data, value_pos, final)
+                    if end is None:
+                        break
+                    pos = end
+                    self._value_done()
+        if pos < len(data):
+            self.retry_size = 2 * (len(data) - pos)
+            self.pending = [data[pos:]]
+        else:
+            self.retry_size = 0
+            self.pending = []
+        self.size = len(data) - pos
+
+
+class JsonArrayReceiver(StringReceiver):
+    """A receiver that decodes the elements of a JSON array as they arrive.
+
+    Only the data of the element currently being received is kept in memory.
+    If `function` is given, it is called on each element and only its result
+    is kept.
+    """
+    def __init__(self, response, finished, function=None,
+                 max_size=32 * 1024 * 1024):
+        StringReceiver.__init__(self, response, finished, max_size)
+        self.function = function
+        self.elements = []
+        self.decoder = JsonArrayDecoder(self.element)
+
+    def element(self, element):
+        if self.function is not None:
+            element = self.function(element)
+        self.elements.append(element)
+
+    def received(self, bytes):
+        try:
+            self.decoder.feed(bytes)
+        except Exception:
+            self.fail(Failure())
+        else:
+            self.set_held(self.decoder.size)
+
+    def connectionLost(self, reason=connectionDone):
+        if not self.finished.called:
+            self.set_held(0)
+            try:
+                self.decoder.close()
+            except Exception:
+                self.finished.errback(Failure())
+            else:
+                self.finished.callback(self.elements)
 
 
 def read_json_response(response):
@@ -106,8 +734,29 @@ def read_json_response(response):
     return d
 
 
+def read_json_array(response, function=None):
+    """Convenience function to read a JSON response that is an array.
+
+    The elements are decoded as they are received. If `function` is given, it
+    is applied to each of them, so only what's needed is kept.
+    """
+    d = defer.Deferred()
+    response.deliverBody(JsonArrayReceiver(response, d, function))
+    d.addCallback(lambda l: (response, l))
+    return d
+
+
+class HTTPError(IOError):
+    """An HTTP request got an error status.
+    """
+    def __init__(self, code, content):
+        IOError.__init__(self, "HTTP %d: %s" % (code, content))
+        self.code = code
+        self.content = content
+
+
 def _assert_fail(content, response):
-    raise IOError("HTTP %d: %s" % (response.code, content))
+    raise HTTPError(response.code, content)
 
 
 def assert_http_200(response):
@@ -125,6 +774,19 @@ def assert_http_200(response):
         return response
 
 
+rate_limiters = []
+
+Gauge('matrix_gitter_rate_limiter_queued',
+      "Operations waiting in a rate limiter",
+      ['operation'],
+      function=lambda: dict(((l.name,), len(l.queue))
+                            for l in rate_limiters))
+Gauge('matrix_gitter_rate_limiter_delay_seconds',
+      "Current delay between operations of a rate limiter",
+      ['operation'],
+      function=lambda: dict(((l.name,), l.delay) for l in rate_limiters))
+
+
 class RateLimiter(object):
     """Limits the rate at which an operation happens.
 
@@ -154,6 +816,8 @@ class RateLimiter(object):
         """
         self.logger = logger.Logger('%s.RateLimiter.%s' % (__name__,
                                                            operation_name))
+        self.name = operation_name
+        rate_limiters.append(self)
         self.min = min
         self.max = max
         self.failed_mult = failed_mult
@@ -179,7 +843,7 @@ class RateLimiter(object):
             next_schedule = self.last_scheduled + self.delay
             wait = max(0, next_schedule - now)
 
-            reactor.callLater(wait, self._do_schedule)
+            timer_wheel.call_later(wait, self._do_schedule)
         self.queue.append((function, args, kwargs))
 
     def _do_schedule(self):
@@ -193,4 +857,265 @@ class RateLimiter(object):
         self.last_scheduled = now
 
         if self.queue:
-            reactor.callLater(self.delay, self._do_schedule)
+            timer_wheel.call_later(self.delay, self._do_schedule)
+
+
+request_caches = []
+
+Counter('matrix_gitter_request_cache_total',
+        "Lookups through request caches, by outcome",
+        ['cache', 'outcome'],
+        function=lambda: dict(
+            item
+            for c in request_caches
+            for item in [((c.name, 'hit'), c.hits),
+                         ((c.name, 'coalesced'), c.coalesced),
+                         ((c.name, 'miss'), c.misses)]))
+
+
+class RequestCache(object):
+    """Caches the results of requests for some time.
+
+    Identical requests that are made while one is already in flight are
+    coalesced: they all get the result of the first one. Failures are not
+    cached.
+
+    Results are shared between callers, don't modify them.
+    """
+    def __init__(self, name, ttl):
+        """New cache.
+
+        :param str name: A name for that cache, used in log messages.
+        :param float ttl: How long to keep results, in seconds.
+        """
+        self.logger = logger.Logger('%s.RequestCache.%s' % (__name__, name))
+        self.name = name
+        request_caches.append(self)
+        self.ttl = ttl
+        self.results = {}
+        self.pending = {}
+        self.last_pruned = time.time()
+
+        # Counters
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+
+    @property
+    def saved(self):
+        """Number of requests that didn't have to be made.
+        """
+        return self.hits + self.coalesced
+
+    def get(self, key, function, *args, **kwargs):
+        """Get the result for `key`, calling `function` if needed.
+
+        The function should return a Deferred.
+        """
+        now = time.time()
+        entry = self.results.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires > now:
+                self.hits += 1
+                return defer.succeed(result)
+            del self.results[key]
+
+        waiting = self.pending.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        self.misses += 1
+        waiting = self.pending[key] = []
+        d = defer.maybeDeferred(function, *args, **kwargs)
+        d.addBoth(self._completed, key, waiting)
+        return d
+
+    def _completed(self, result, key, waiting):
+        # Only store if it wasn't invalidated while in flight
+        if self.pending.get(key) is waiting:
+            del self.pending[key]
+            if not isinstance(result, Failure):
+                now = time.time()
+                self.results[key] = now + self.ttl, result
+                if now > self.last_pruned + self.ttl:
+                    self.prune(now)
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+    def invalidate(self, key):
+        """Forget the result for `key`.
+
+        A request in flight will not be cached, although its result will
+        still be delivered.
+        """
+        self.results.pop(key, None)
+        self.pending.pop(key, None)
+
+    def invalidate_matching(self, predicate):
+        """Forget the results of all the keys for which `predicate` is true.
+        """
+        for key in [k for k in self.results if predicate(k)]:
+            del self.results[key]
+        for key in [k for k in self.pending if predicate(k)]:
+            del self.pending[key]
+
+    def prune(self, now=None):
+        """Drop the results that have expired.
+        """
+        if now is None:
+            now = time.time()
+        self.last_pruned = now
+        for key in [k for k, (expires, r) in self.results.iteritems()
+                    if expires <= now]:
+            del self.results[key]
+        self.logger.debug("{entries} entries, {saved} requests saved, "
+                          "{misses} made",
+                          entries=len(self.results), saved=self.saved,
+                          misses=self.misses)
+
+
+def is_transient_error(err, idempotent=True):
+    """Whether a failed request is worth retrying.
+
+    Client errors are not, except for 408 Request Timeout. Rate limiting
+    isn't either: the Gitter scheduler already retries after the reset.
+
+    If the request is not `idempotent`, it is only retried if it's sure that
+    the server didn't get it: after our own timeout or a dropped connection,
+    the message might have been posted already.
+    """
+    if err.check(HTTPError):
+        code = err.value.code
+        return code >= 500 or code == 408
+    if idempotent:
+        return True
+    return (err.check(ConnectError, CircuitOpenError, RequestNotSent)
+            is not None)
+
+
+class OutboundQueue(object):
+    """Delivers messages in order, retrying the ones that fail.
+
+    Up to `window` messages are handed to `send` at a time. When one fails,
+    nothing more is sent until it has been retried, after a delay that grows
+    with each attempt. Messages that still fail after `retries` attempts, or
+    that fail with a permanent error, are handed to `failed` and dropped.
+
+    Note that with a window of more than 1, the messages after a failed one
+    might already have been sent.
+    """
+    def __init__(self, name, send, failed, window=1, retries=5,
+                 min_delay=2, max_delay=60, delay_mult=2, idempotent=True,
+                 dropped=None):
+        """New queue.
+
+        :param str name: A name for this queue, used in log messages.
+        :param send: Function called with a message and the attempt number
+            (starting at 1), returning a Deferred.
+        :param failed: Function called with a message and the Failure when
+            it is dropped.
+        :param bool idempotent: Whether sending a message twice is harmless.
+            If not, messages are not retried when they might have been sent.
+        :param dropped: Function called with each message that was never
+            sent because the queue was stopped.
+        """
+        self.logger = logger.Logger('%s.OutboundQueue.%s' % (__name__, name))
+        self.name = name
+        self.send = send
+        self.failed = failed
+        self.window = window
+        self.retries = retries
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay_mult = delay_mult
+        self.idempotent = idempotent
+        self.dropped = dropped
+
+        self.next_seq = 0
+        self.pending = []
+        self.in_flight = 0
+        self.retry_call = None
+        self.stopped = False
+
+    def __len__(self):
+        return len(self.pending) + self.in_flight
+
+    def put(self, message):
+        """Queue a message for delivery.
+        """
+        if self.stopped:
+            return
+        self.pending.append([self.next_seq, message, 0])
+        self.next_seq += 1
+        self._pump()
+
+    def stop(self):
+        """Drop the messages that haven't been sent yet, stop retrying.
+        """
+        self.stopped = True
+        if self.retry_call is not None and self.retry_call.active():
+            self.retry_call.cancel()
+        self.retry_call = None
+        pending, self.pending = self.pending, []
+        if pending:
+            self.logger.info("Dropping {nb} messages", nb=len(pending))
+        if self.dropped is not None:
+            for seq, message, attempts in pending:
+                try:
+                    self.dropped(message)
+                except Exception:
+                    self.logger.failure("Error reporting dropped message")
+
+    def _pump(self):
+        while (self.pending and self.retry_call is None and
+                self.in_flight < self.window):
+            entry = self.pending.pop(0)
+            entry[2] += 1
+            self.in_flight += 1
+            d = defer.maybeDeferred(self.send, entry[1], entry[2])
+            d.addCallbacks(self._sent, self._send_failed,
+                           errbackArgs=(entry,))
+
+    def _sent(self, result):
+        self.in_flight -= 1
+        self._pump()
+
+    def _send_failed(self, err, entry):
+        self.in_flight -= 1
+        seq, message, attempts = entry
+        if (not self.stopped and attempts < self.retries and
+                is_transient_error(err, self.idempotent)):
+            delay = min(self.min_delay * self.delay_mult ** (attempts - 1),
+                        self.max_delay)
+            self.logger.info("Sending failed ({error}), retrying in "
+                             "{delay:.1f}s",
+                             error=err.getErrorMessage(), delay=delay)
+            flight.record('outbound_retry', queue=self.name,
+                          attempts=attempts, delay=delay, queued=len(self))
+            # Put it back in order, before the messages that came after it
+            i = 0
+            while i < len(self.pending) and self.pending[i][0] < seq:
+                i += 1
+            self.pending.insert(i, entry)
+            if self.retry_call is None:
+                self.retry_call = timer_wheel.call_later(delay, self._retry)
+        else:
+            self.logger.failure("Giving up on message after {attempts} "
+                                "attempts", err, attempts=attempts)
+            try:
+                self.failed(message, err)
+            except Exception:
+                self.logger.failure("Error reporting failed message")
+            self._pump()
+
+    def _retry(self):
+        self.retry_call = None
+        self._pump()
@@ -18,6 +18,7 @@ req = [
 setup(name='matrix-gitter-twisted',
       version='0.1',
       packages=['matrix_gitter'],
+      package_data={'matrix_gitter': ['emoji.txt']},
       entry_points={
           'console_scripts': [
               'matrix_gitter = matrix_gitter.main:main']},
@@ -0,0 +1,318 @@
+"""Leak check: runs the bridge under load and checks that memory stays flat.
+
+The bridge runs in-process against the fake Gitter server and the fake
+homeserver, with the real Journal and Renderer. Each round sends messages
+both ways, then waits for the bridge to be idle and measures the resident
+memory, the open file descriptors, and the resources held by the rooms.
+
+After the warm-up rounds, memory must not grow by more than `--max-growth`
+megabytes, the number of file descriptors must not change, and the rooms
+must not hold anything once idle. Exits with status 1 otherwise.
+
+Run it with ``python -m tests.soak``; it only works on Linux (it reads
+/proc).
+"""
+
+import argparse
+import gc
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from twisted.internet import defer, reactor
+from twisted import logger
+from twisted.web.server import Site
+
+# We chdir to a temporary directory later, so the modules' paths have to be
+# absolute
+sys.path[:] = [os.path.abspath(path) for path in sys.path]
+
+from matrix_gitter.bridge import Bridge, gitter_stream_limit
+from matrix_gitter.fake_gitter import FakeGitter, fake_gitter_resource
+from matrix_gitter.fake_homeserver import FakeHomeserver, \
+    fake_homeserver_resource
+
+
+SEND_ENDPOINT = 'PUT rooms/%s/send/m.room.message/%s'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def rss_mb():
+    with open('/proc/self/statm') as fp:
+        pages = int(fp.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024.0)
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+
+@defer.inlineCallbacks
+def wait_for(predicate, what, timeout=60):
+    end = time.time() + timeout
+    while not predicate():
+        if time.time() > end:
+            raise RuntimeError("Timed out waiting for %s" % what)
+        yield sleep(0.05)
+
+
+class CountingGitter(FakeGitter):
+    def __init__(self, *args, **kwargs):
+        FakeGitter.__init__(self, *args, **kwargs)
+        self.posted = 0
+
+    def post(self, room_id, user, text):
+        self.posted += 1
+        return FakeGitter.post(self, room_id, user, text)
+
+
+def message(i):
+    """Make a message, some with markup and some long.
+    """
+    kind = i % 4
+    if kind == 0:
+        return "plain message number %d" % i
+    elif kind == 1:
+        return "message *%d* with `markup` and :smile: http://x.com/a_b" % i
+    elif kind == 2:
+        return "```\n%s\n```" % '\n'.join("line %d" % j for j in range(50))
+    else:
+        return "long message " + "word " * random.randrange(100, 2000)
+
+
+class Soak(object):
+    def __init__(self, args):
+        self.args = args
+        # Don't wait 10 seconds between opening each stream
+        gitter_stream_limit.min = gitter_stream_limit.delay = 0.01
+        self.gitter = CountingGitter(rate_limit=10 ** 9, heartbeat=1)
+        gitter_port = reactor.listenTCP(
+            0, Site(fake_gitter_resource(self.gitter)),
+            interface='127.0.0.1').getHost().port
+        appservice_port = free_port()
+        self.homeserver = FakeHomeserver(
+            'http://127.0.0.1:%d/' % appservice_port, 'as_token', 'hs_token',
+            'localhost')
+        homeserver_port = reactor.listenTCP(
+            0, Site(fake_homeserver_resource(self.homeserver)),
+            interface='127.0.0.1').getHost().port
+        gitter_url = 'http://127.0.0.1:%d/' % gitter_port
+        self.bridge = Bridge({
+            'unique_secret_key': 'soak',
+            'matrix_appservice_port': appservice_port,
+            'matrix_appservice_bind_address': '127.0.0.1',
+            'matrix_homeserver_url': 'http://127.0.0.1:%d/' % homeserver_port,
+            'matrix_homeserver_domain': 'localhost',
+            'matrix_botname': '@gitter:localhost',
+            'matrix_appservice_token': 'as_token',
+            'matrix_homeserver_token': 'hs_token',
+            'gitter_login_port': free_port(),
+            'gitter_login_url': 'http://127.0.0.1/',
+            'gitter_oauth_key': 'key',
+            'gitter_oauth_secret': 'secret',
+            'gitter_api_url': gitter_url,
+            'gitter_stream_url': gitter_url + 'stream/',
+            'gitter_oauth_url': gitter_url,
+            'reactor_lag_threshold': None,
+        })
+
+    def held(self):
+        """Total of the resources held by the rooms, except open streams.
+        """
+        return sum(value
+                   for room in self.bridge.rooms_matrix.itervalues()
+                   for resource, value in room.resources().iteritems()
+                   if resource != 'streams')
+
+    def sent_to_matrix(self):
+        stats = self.homeserver.stats.get(SEND_ENDPOINT)
+        return stats.codes.get(200, 0) if stats is not None else 0
+
+    def idle(self):
+        return (not self.homeserver.pending and
+                self.homeserver.transaction is None and
+                self.held() == 0)
+
+    @defer.inlineCallbacks
+    def wait_idle(self):
+        # Idle, with nothing delivered for a little while
+        last = None
+        while True:
+            yield wait_for(self.idle, "the bridge to be idle")
+            counts = self.gitter.posted, self.sent_to_matrix()
+            if counts == last:
+                return
+            last = counts
+            yield sleep(0.3)
+
+    @defer.inlineCallbacks
+    def setup(self):
+        args = self.args
+        # Inviting the bot before it registers makes registration fail
+        yield wait_for(lambda: self.homeserver.bot in self.homeserver.users,
+                       "the bot to register")
+        rooms = [self.gitter.add_room('soak/room%d' % i)
+                 for i in xrange(args.rooms)]
+        self.gitter_rooms = [room['id'] for room in rooms]
+        self.sender = self.gitter.add_user('someone')
+        users = []
+        for i in xrange(args.users):
+            users.append((self.homeserver.add_user('user%d' % i),
+                          self.gitter.add_user('guser%d' % i)))
+        yield wait_for(
+            lambda: all(self.bridge.get_user(matrix_user) is not None and
+                        self.bridge.get_user(matrix_user).matrix_private_room
+                        for matrix_user, gitter_user in users),
+            "private rooms")
+        for matrix_user, gitter_user in users:
+            self.bridge.set_gitter_info(matrix_user, gitter_user['username'],
+                                        gitter_user['id'],
+                                        self.gitter.new_token(gitter_user))
+            private_room = self.bridge.get_user(
+                matrix_user).matrix_private_room
+            for room in rooms:
+                self.homeserver.say(matrix_user, private_room,
+                                    'invite %s' % room['uri'])
+        yield wait_for(
+            lambda: len(self.bridge.rooms_matrix) == args.users * args.rooms,
+            "linked rooms")
+        self.matrix_rooms = [
+            (room.matrix_room, room.user.matrix_username)
+            for room in self.bridge.rooms_matrix.itervalues()]
+        yield wait_for(
+            lambda: all(self.homeserver.rooms[room].get(user) == 'join'
+                        for room, user in self.matrix_rooms),
+            "users to join the linked rooms")
+        yield wait_for(
+            lambda: all(room.stream_response is not None
+                        for room in self.bridge.rooms_matrix.itervalues()),
+            "streams")
+        # Have the virtual users join the rooms one at a time first
+        for gitter_user in [self.sender] + [g for m, g in users]:
+            for room in self.gitter_rooms:
+                self.gitter.post(room, gitter_user, "hello")
+            yield self.wait_idle()
+
+    @defer.inlineCallbacks
+    def round(self):
+        for i in xrange(self.args.messages):
+            if i % 2:
+                self.gitter.post(random.choice(self.gitter_rooms),
+                                 self.sender, message(i // 2))
+            else:
+                room, user = random.choice(self.matrix_rooms)
+                self.homeserver.say(user, room, message(i // 2))
+            if i % 10 == 9:
+                yield sleep(10.0 / self.args.rate)
+        yield self.wait_idle()
+
+    @defer.inlineCallbacks
+    def run(self):
+        args = self.args
+        yield self.setup()
+        print "%d users, %d rooms each, %d messages per round" % (
+            args.users, args.rooms, args.messages)
+        print "round   to gitter   to matrix   rss (MB)   fds"
+        baseline = None
+        failures = []
+        for i in xrange(1, args.rounds + 1):
+            to_gitter, to_matrix = self.gitter.posted, self.sent_to_matrix()
+            yield self.round()
+            # The fake homeserver remembers every transaction ID forever
+            self.homeserver.txns.clear()
+            gc.collect()
+            rss, fds = rss_mb(), open_fds()
+            print "%5d %11d %11d %10.1f %5d" % (
+                i, self.gitter.posted - to_gitter,
+                self.sent_to_matrix() - to_matrix, rss, fds)
+            if i == args.warmup:
+                baseline = rss, fds
+            elif baseline is not None:
+                if rss - baseline[0] > args.max_growth:
+                    failures.append("round %d: memory grew by %.1fMB" % (
+                        i, rss - baseline[0]))
+                if fds != baseline[1]:
+                    failures.append("round %d: %d file descriptors, was %d" %
+                                    (i, fds, baseline[1]))
+            if self.held():
+                failures.append("round %d: rooms still hold %d resources" %
+                                (i, self.held()))
+        defer.returnValue(failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the bridge's memory stays flat under load")
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--rooms', type=int, default=4,
+                        help="Gitter rooms, each user is in all of them")
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=5,
+                        help="Rounds before taking the baseline")
+    parser.add_argument('--messages', type=int, default=1000,
+                        help="Messages per round, half in each direction")
+    parser.add_argument('--rate', type=float, default=200,
+                        help="Messages sent per second")
+    parser.add_argument('--max-growth', type=float, default=2.0,
+                        help="Memory growth allowed after warm-up, in MB")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # Only show problems; this also stops Twisted buffering log events
+    predicate = logger.LogLevelFilterPredicate(logger.LogLevel.warn)
+    observer = logger.FilteringLogObserver(
+        logger.FileLogObserver(sys.stderr,
+                               logger.formatEventAsClassicLogText),
+        [predicate])
+    logger.globalLogBeginner.beginLoggingTo([observer],
+                                            redirectStandardIO=False)
+
+    # The bridge writes its database and journal to the current directory
+    directory = tempfile.mkdtemp(prefix='matrix_gitter_soak_')
+    os.chdir(directory)
+    result = []
+
+    def done(failures):
+        result.extend(failures)
+        reactor.stop()
+
+    def error(err):
+        result.append(err.getTraceback())
+        reactor.stop()
+
+    def start():
+        d = Soak(args).run()
+        d.addCallbacks(done, error)
+
+    reactor.callWhenRunning(start)
+    try:
+        reactor.run()
+    finally:
+        shutil.rmtree(directory)
+
+    if result:
+        for failure in result:
+            sys.stderr.write("FAILED: %s\n" % failure)
+        sys.exit(1)
+    print "OK"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import json
+from twisted.internet import defer
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+# Importing those registers their metrics
+from matrix_gitter import bridge, gitter  # noqa
+from matrix_gitter.admin import Metrics, Rooms
+from matrix_gitter import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def get(self, headers={}, token='secret'):
+        request = DummyRequest([])
+        for name, value in headers.iteritems():
+            request.requestHeaders.setRawHeaders(name, [value])
+        result = Metrics(None, token).render(request)
+        return request.responseCode or 200, result
+
+    def test_token(self):
+        """Metrics are only served with the admin token.
+        """
+        self.assertEqual(self.get()[0], 401)
+        self.assertEqual(
+            self.get({'Authorization': 'Bearer wrong'})[0], 403)
+        code, result = self.get({'Authorization': 'Bearer secret'})
+        self.assertEqual(code, 200)
+        self.assertIn('\nmatrix_gitter_resources{resource="rooms"} 0\n',
+                      result)
+
+    def test_unicode_token(self):
+        """The token from the settings can be unicode.
+        """
+        self.assertEqual(
+            self.get({'Authorization': 'Bearer wrong'}, u'secr\xe9t')[0],
+            403)
+        self.assertEqual(
+            self.get({'Authorization': 'Bearer secr\xc3\xa9t'},
+                     u'secr\xe9t')[0],
+            200)
+
+    def test_registered_once(self):
+        names = [metric.name for metric in metrics.registry]
+        self.assertEqual(sorted(names), sorted(set(names)))
+
+
+class FakeUser(object):
+    def __init__(self, matrix_username, github_username):
+        self.matrix_username = matrix_username
+        self.github_username = github_username
+
+
+class FakeRoom(object):
+    gitter_room_name = u'org/room'
+    state_since = last_data = last_received = last_sent = None
+
+    def __init__(self, matrix_room, user):
+        self.matrix_room = matrix_room
+        self.user = user
+
+    def status(self, now):
+        return 'streaming'
+
+    def resources(self):
+        return {}
+
+
+class FakeBridge(object):
+    def __init__(self, rooms):
+        self.rooms_matrix = dict((room.matrix_room, room) for room in rooms)
+
+
+class TestRooms(unittest.TestCase):
+    def get(self, bridge=None, **args):
+        request = DummyRequest([])
+        request.requestHeaders.setRawHeaders('Authorization',
+                                             ['Bearer secret'])
+        request.args = dict((k, [v]) for k, v in args.iteritems())
+        request._disconnected = False
+        result = Rooms(bridge, 'secret').render(request)
+        return request.responseCode, result, request
+
+    @defer.inlineCallbacks
+    def test_user_filter(self):
+        """Non-ASCII usernames can be filtered on.
+        """
+        bridge = FakeBridge([
+            FakeRoom(u'!a:example.org',
+                     FakeUser(u'@j\xe9r\xf4me:example.org', u'jerome')),
+            FakeRoom(u'!b:example.org',
+                     FakeUser(u'@other:example.org', u'other'))])
+        code, result, request = self.get(
+            bridge, user=u'@j\xe9r\xf4me:example.org'.encode('utf-8'))
+        yield request.notifyFinish()
+        result = json.loads(''.join(request.written))
+        self.assertEqual([room['matrix_room'] for room in result['rooms']],
+                         [u'!a:example.org'])
+    test_user_filter.timeout = 5
+
+    def test_invalid_parameters(self):
+        """Malformed parameters are rejected, rather than erroring out.
+        """
+        self.assertEqual(self.get(limit='ten')[0], 400)
+        self.assertEqual(self.get(limit='0')[0], 400)
+        self.assertEqual(self.get(limit='1001')[0], 400)
+        self.assertEqual(self.get(after='!\xff:example.org')[0], 400)
+        self.assertEqual(self.get(user='@\xff:example.org')[0], 400)
@@ -0,0 +1,67 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from matrix_gitter import bridge
+from matrix_gitter.bridge import Room, User
+from matrix_gitter.journal import Journal
+
+
+class FakeGitter(object):
+    def __init__(self):
+        self.requests = []
+
+    def gitter_request(self, method, uri, content, *args, **kwargs):
+        d = defer.Deferred()
+        self.requests.append(d)
+        return d
+
+
+class FakeResponse(object):
+    code = 200
+
+
+class FakeBridge(object):
+    gitter_send_window = 1
+    gitter_send_retries = 5
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.gitter = FakeGitter()
+
+    def journal_add(self, kind, data):
+        return self.journal.add(kind, data)
+
+    def journal_done(self, journal_id):
+        self.journal.done(journal_id)
+
+    def destroy_room(self, room):
+        pass
+
+
+class FakeLimiter(object):
+    def schedule(self, function):
+        pass
+
+
+class TestRoom(unittest.TestCase):
+    def setUp(self):
+        self.patch(bridge, 'gitter_stream_limit', FakeLimiter())
+        self.journal = Journal(self.mktemp())
+        self.addCleanup(self.journal.close)
+        self.bridge = FakeBridge(self.journal)
+        user = User(u'@user:example.org', u'!private:example.org',
+                    u'user', u'id', u'token')
+        self.room = Room(self.bridge, user, u'!room:example.org',
+                         u'org/room', u'roomid')
+
+    def test_destroy(self):
+        """Messages still queued when the room goes away leave the journal.
+        """
+        for i in range(3):
+            self.room.to_gitter(u'message %d' % i)
+        self.assertEqual(len(self.bridge.gitter.requests), 1)
+        self.room.destroy()
+        self.assertEqual(len(self.journal.pending()), 1)
+        # The one in flight is done once it completes
+        self.bridge.gitter.requests[0].callback(FakeResponse())
+        self.assertEqual(self.journal.pending(), [])
@@ -0,0 +1,32 @@
+from collections import deque
+import os
+from twisted.trial import unittest
+
+from matrix_gitter import flight
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.patch(flight, '_directory', self.directory)
+        self.patch(flight, '_keep', 3)
+        self.patch(flight, '_events', deque(maxlen=100))
+
+    def test_keep(self):
+        """Only the last dumps are kept.
+        """
+        # Not a dump
+        open(os.path.join(self.directory, 'flight.txt'), 'w').close()
+        names = [os.path.basename(flight.dump_file()) for i in xrange(5)]
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         names[2:] + ['flight.txt'])
+
+    def test_shutdown(self):
+        flight.record('test', n=1)
+        flight._on_shutdown()
+        name, = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name)) as fp:
+            lines = fp.read().splitlines()
+        self.assertTrue(lines[-2].endswith(' test n=1'))
+        self.assertTrue(lines[-1].endswith(' shutdown '))
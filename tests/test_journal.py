@@ -0,0 +1,76 @@
+import json
+import os
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from matrix_gitter.journal import Journal
+
+
+class TestJournal(unittest.TestCase):
+    def write_segment(self, path, segment, records):
+        with open(os.path.join(path, '%010d.log' % segment), 'wb') as fp:
+            for record in records:
+                fp.write(json.dumps(record) + '\n')
+
+    def segment_files(self, path):
+        return sorted(os.listdir(path))
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        path = self.mktemp()
+        journal = Journal(path)
+        first = journal.add('send', {'text': 'one'})
+        second = journal.add('send', {'text': 'two'})
+        journal.done(first)
+        yield journal.close()
+
+        journal = Journal(path)
+        self.assertEqual(journal.pending(),
+                         [(second, 'send', {'text': 'two'})])
+        yield journal.close()
+
+    @defer.inlineCallbacks
+    def test_crash_during_compaction(self):
+        """Records copied forward before a crash are only counted once.
+        """
+        path = self.mktemp()
+        os.makedirs(path)
+        # Segment 0 had its records copied to segment 1, but was not
+        # removed
+        self.write_segment(path, 0, [['a', 0, 'send', {}],
+                                     ['a', 1, 'send', {}]])
+        self.write_segment(path, 1, [['a', 0, 'send', {}],
+                                     ['a', 1, 'send', {}],
+                                     ['d', 0]])
+        journal = Journal(path)
+        self.assertEqual([id_ for id_, k, d in journal.pending()], [1])
+        self.assertEqual(journal.segments, {1: 1, 2: 0})
+        self.assertEqual(self.segment_files(path),
+                         ['0000000001.log', '0000000002.log'])
+
+        journal.done(1)
+        self.assertEqual(self.segment_files(path), ['0000000002.log'])
+        yield journal.close()
+
+    @defer.inlineCallbacks
+    def test_compact_then_close(self):
+        path = self.mktemp()
+        journal = Journal(path, segment_size=64)
+        ids = [journal.add('send', {'text': 'message %d' % i})
+               for i in range(5)]
+        self.assertTrue(len(journal.segments) > 1)
+        fds = journal.closing_fds + [journal.fd]
+        compacted = journal.segment
+        journal.compact()
+        # Old segments stay until the copies are synced
+        journal.done(ids[0])
+        self.assertIn('0000000000.log', self.segment_files(path))
+        yield journal.close()
+        self.assertEqual(self.segment_files(path)[0],
+                         '%010d.log' % compacted)
+        for fd in fds:
+            self.assertRaises(OSError, os.fstat, fd)
+
+        journal = Journal(path)
+        self.assertEqual([id_ for id_, k, d in journal.pending()], ids[1:])
+        yield journal.close()
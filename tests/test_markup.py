@@ -0,0 +1,89 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from matrix_gitter import markup
+
+
+def broken(msg):
+    raise ValueError("broken renderer")
+
+
+class TestRenderer(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_inline_error(self):
+        """A rendering error gives the escaped text instead of failing.
+        """
+        self.patch(markup, 'gitter_to_matrix', broken)
+        renderer = markup.Renderer()
+        html = yield renderer.gitter_to_matrix('a <b> *c*')
+        self.assertEqual(html, 'a &lt;b&gt; *c*')
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+
+    @defer.inlineCallbacks
+    def test_worker_error(self):
+        """A rendering error in a worker doesn't wait for the timeout.
+        """
+        self.patch(markup, 'gitter_to_matrix', broken)
+        renderer = markup.Renderer(processes=1, threshold=0, timeout=30)
+        self.addCleanup(renderer.pool.terminate)
+        d = renderer.gitter_to_matrix('a <b> *c*')
+        html = yield d
+        self.assertEqual(html, 'a &lt;b&gt; *c*')
+    test_worker_error.timeout = 5
+
+
+class TestMatrixToGitter(unittest.TestCase):
+    def convert(self, html, body='body'):
+        return markup.matrix_to_gitter(body, html)
+
+    def test_formatting(self):
+        self.assertEqual(self.convert('hello <b>world</b>'),
+                         'hello **world**')
+        self.assertEqual(
+            self.convert('<blockquote><a href="http://a/b">link</a> at '
+                         'start</blockquote>'),
+            '> [link](http://a/b) at start')
+        self.assertEqual(
+            self.convert('<pre><code class="language-py">a_b * 2\n'
+                         '&lt;b&gt;\n</code></pre>'),
+            '```py\na_b * 2\n<b>\n```')
+
+    def test_escaping(self):
+        self.assertEqual(
+            self.convert('a * b _c_ `d` [e] ~f~ \\ &lt;g&gt; &amp;amp;'),
+            'a \\* b \\_c\\_ \\`d\\` \\[e\\] \\~f\\~ \\\\ &lt;g> &amp;amp;')
+        self.assertEqual(
+            self.convert('<p># a</p><p>- b</p><p>1. c</p><p>&gt; d</p>'),
+            '\\# a\n\n\\- b\n\n1\\. c\n\n\\> d')
+        self.assertEqual(
+            self.convert('<a href="http://x/(a)">li_nk</a>'),
+            '[li\\_nk](http://x/%28a%29)')
+
+    def test_urls(self):
+        """URLs in text are not escaped, Gitter turns them into links.
+        """
+        self.assertEqual(
+            self.convert('see http://x/a_b?c=1&amp;d_e=2 or_not'),
+            'see http://x/a_b?c=1&d_e=2 or\\_not')
+        self.assertEqual(
+            self.convert('<a href="http://x/a_b">http://x/a_b</a>'),
+            'http://x/a_b')
+
+    def test_inline_code(self):
+        self.assertEqual(self.convert('<code>a*b_c</code>'), '`a*b_c`')
+        self.assertEqual(self.convert('<code>a `b` c</code>'),
+                         '``a `b` c``')
+        self.assertEqual(self.convert('<code>``x`</code>'),
+                         '``` ``x` ```')
+
+    def test_block_code_fence(self):
+        """A fence in a code block doesn't end it.
+        """
+        self.assertEqual(
+            self.convert('<pre><code>a\n```\nb\n</code></pre>'),
+            '````\na\n```\nb\n````')
+
+    def test_reply(self):
+        quote = '<mx-reply><blockquote>quoted</blockquote></mx-reply>'
+        self.assertEqual(self.convert(quote + 'reply'), 'reply')
+        self.assertEqual(self.convert(quote, '> quoted'), '> quoted')
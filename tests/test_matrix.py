@@ -0,0 +1,52 @@
+from StringIO import StringIO
+from twisted.trial import unittest
+from twisted.web.test.requesthelper import DummyRequest
+
+from matrix_gitter.matrix import Transaction
+
+
+class FakeAPI(object):
+    token_hs = 'hs_token'
+
+
+class RecordingTransaction(Transaction):
+    def __init__(self):
+        Transaction.__init__(self, FakeAPI())
+        self.events = []
+
+    def handle_event(self, event):
+        if event.get('broken'):
+            raise KeyError('broken')
+        self.events.append(event['n'])
+
+
+class TestTransaction(unittest.TestCase):
+    def put(self, resource, txn, body):
+        request = DummyRequest([txn])
+        request.method = 'PUT'
+        request.args = {'access_token': ['hs_token']}
+        request.content = StringIO(body)
+        result = resource.render(request)
+        return request.responseCode or 200, result
+
+    def test_retry_after_invalid(self):
+        """Events handled before a decoding error are not handled again.
+        """
+        resource = RecordingTransaction()
+        code, result = self.put(resource, '1',
+                                '{"events": [{"n": 1}, {"n": 2} {"n": 3}]}')
+        self.assertEqual(code, 400)
+        self.assertEqual(resource.events, [1, 2])
+        code, result = self.put(resource, '1',
+                                '{"events": [{"n": 1}, {"n": 2}, {"n": 3}]}')
+        self.assertEqual(code, 200)
+        self.assertEqual(resource.events, [1, 2, 3])
+
+    def test_duplicate(self):
+        resource = RecordingTransaction()
+        body = '{"events": [{"n": 1}, {"broken": true}, {"n": 2}]}'
+        self.assertEqual(self.put(resource, '1', body), (200, '{}'))
+        self.assertEqual(self.put(resource, '1', body), (200, '{}'))
+        self.assertEqual(self.put(resource, '2', body), (200, '{}'))
+        self.assertEqual(resource.events, [1, 2, 1, 2])
+        self.assertEqual(len(self.flushLoggedErrors(KeyError)), 2)
@@ -0,0 +1,51 @@
+import thread
+import time
+from twisted.internet import defer, reactor
+from twisted.logger import globalLogPublisher
+from twisted.trial import unittest
+
+from matrix_gitter.profiler import LagMonitor, Profiler
+
+
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+
+class TestProfiler(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_sampling_error(self):
+        """An error while sampling fails the profile and frees the profiler.
+        """
+        profiler = Profiler(self.mktemp())
+
+        def broken(thread_id, duration, interval):
+            raise ValueError("broken sampler")
+        profiler._collect = broken
+
+        yield self.assertFailure(profiler.start(0.01), ValueError)
+        self.assertIsNone(profiler.running)
+    test_sampling_error.timeout = 5
+
+
+class TestLagMonitor(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_stall_logged_from_reactor(self):
+        """The watchdog thread doesn't log itself, it leaves it to the reactor.
+        """
+        events = []
+
+        def observer(event):
+            if 'stack' in event:
+                events.append(thread.get_ident())
+        globalLogPublisher.addObserver(observer)
+        self.addCleanup(globalLogPublisher.removeObserver, observer)
+
+        monitor = LagMonitor(interval=0.05, threshold=0.1)
+        self.addCleanup(monitor.stop)
+        yield sleep(0.1)
+        time.sleep(0.5)
+        yield sleep(0.1)
+        self.assertEqual(events, [thread.get_ident()])
+    test_stall_logged_from_reactor.timeout = 5
@@ -0,0 +1,278 @@
+import json
+from twisted.internet import defer, reactor
+from twisted.internet.error import ConnectionRefusedError
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone, ResponseFailed
+import zlib
+
+from matrix_gitter import utils
+from matrix_gitter.utils import CircuitBreaker, CircuitOpenError, \
+    HTTPError, JsonArrayDecoder, OutboundQueue, TimerWheel, \
+    _DeflateProtocol
+
+
+def sleep(seconds):
+    d = defer.Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+
+class TestTimerWheel(unittest.TestCase):
+    def advance_calls(self, wheel):
+        return [c for c in reactor.getDelayedCalls()
+                if getattr(c.func, 'im_self', None) is wheel]
+
+    @defer.inlineCallbacks
+    def test_reschedule_from_callback(self):
+        """Timers scheduled from a timer keep a single delayed call.
+        """
+        wheel = TimerWheel(tick=0.01)
+        fired = []
+        max_calls = [0]
+
+        def callback(n):
+            fired.append(n)
+            if n < 10:
+                wheel.call_later(0.02, callback, n + 1)
+                wheel.call_later(0.05, lambda: None)
+            max_calls[0] = max(max_calls[0],
+                               len(self.advance_calls(wheel)))
+
+        wheel.call_later(0.01, callback, 0)
+        yield sleep(0.5)
+        self.assertEqual(fired, range(11))
+        self.assertEqual(max_calls[0], 0)
+        self.assertEqual(wheel.count, 0)
+        self.assertEqual(self.advance_calls(wheel), [])
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        wheel = TimerWheel(tick=0.01)
+        fired = []
+        timer = wheel.call_later(0.02, fired.append, 1)
+        wheel.call_later(0.03, fired.append, 2)
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+        yield sleep(0.1)
+        self.assertEqual(fired, [2])
+        self.assertEqual(self.advance_calls(wheel), [])
+
+
+class TestJsonArrayDecoder(unittest.TestCase):
+    def decode(self, data, chunk_size=None, key=None):
+        elements = []
+        decoder = JsonArrayDecoder(elements.append, key=key)
+        if chunk_size is None:
+            decoder.feed(data)
+        else:
+            for i in xrange(0, len(data), chunk_size):
+                decoder.feed(data[i:i + chunk_size])
+        decoder.close()
+        return elements
+
+    def test_array(self):
+        data = ' [1, -2.5, "a,]", {"b": [3, 4]}, [], null, true] '
+        expected = [1, -2.5, 'a,]', {'b': [3, 4]}, [], None, True]
+        self.assertEqual(self.decode(data), expected)
+        for chunk_size in (1, 2, 3, 7):
+            self.assertEqual(self.decode(data, chunk_size), expected)
+        self.assertEqual(self.decode('[]'), [])
+
+    def test_key(self):
+        data = ('{"a": 1, "b": {"events": [9]}, "events": [{"c": 2}, 3],'
+                ' "d": []}')
+        expected = [{'c': 2}, 3]
+        self.assertEqual(self.decode(data, key='events'), expected)
+        for chunk_size in (1, 4):
+            self.assertEqual(self.decode(data, chunk_size, 'events'),
+                             expected)
+        self.assertEqual(self.decode('{"x": 1, "events": []}',
+                                     key='events'), [])
+
+    def test_invalid(self):
+        for data in ('[,1]', '[1 2]', '[1,,2]', '[1,]', '[1', '1', '[1]]',
+                     '[1:2]', '[1] 2'):
+            for chunk_size in (None, 1):
+                self.assertRaises(ValueError, self.decode, data, chunk_size)
+        for data in ('{,"events": []}', '{"a": 1 "events": []}',
+                     '{"a": 1,, "events": []}', '{"events": [],}',
+                     '{1: 2, "events": []}', '{"events": [1}'):
+            self.assertRaises(ValueError, self.decode, data, key='events')
+
+    def test_large_element(self):
+        """Feeding a large element in small chunks is not quadratic.
+        """
+        element = {'body': 'x' * 1000000}
+        data = json.dumps([element, 1])
+        elements = []
+        decoder = JsonArrayDecoder(elements.append)
+        for i in xrange(0, len(data), 1000):
+            decoder.feed(data[i:i + 1000])
+            self.assertTrue(decoder.size <= 2 * len(data))
+        decoder.close()
+        self.assertEqual(elements, [element, 1])
+
+
+class Collect(object):
+    def __init__(self):
+        self.chunks = []
+        self.reason = None
+
+    def dataReceived(self, data):
+        self.chunks.append(data)
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+class TestDeflateProtocol(unittest.TestCase):
+    def deliver(self, data, step):
+        collect = Collect()
+        protocol = _DeflateProtocol(collect, None)
+        for i in xrange(0, len(data), step):
+            protocol.dataReceived(data[i:i + step])
+        protocol.connectionLost(Failure(ResponseDone()))
+        self.assertIsNotNone(collect.reason)
+        return collect.chunks
+
+    def test_zlib(self):
+        """Zlib-wrapped data, with the header split across chunks.
+        """
+        body = 'hello world ' * 100
+        self.assertEqual(''.join(self.deliver(zlib.compress(body), 1)), body)
+
+    def test_raw(self):
+        """Raw deflate data.
+        """
+        body = 'hello world ' * 100
+        compress = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        data = compress.compress(body) + compress.flush()
+        for step in (1, 7, len(data)):
+            self.assertEqual(''.join(self.deliver(data, step)), body)
+
+    def test_bounded(self):
+        """Highly compressed data is decompressed a chunk at a time.
+        """
+        body = '\0' * (10 * 1024 * 1024)
+        chunks = self.deliver(zlib.compress(body, 9), 65536)
+        self.assertTrue(max(len(c) for c in chunks) <=
+                        _DeflateProtocol.chunk_size)
+        self.assertEqual(sum(len(c) for c in chunks), len(body))
+
+    def test_invalid(self):
+        protocol = _DeflateProtocol(Collect(), None)
+        self.assertRaises(ResponseFailed, protocol.dataReceived,
+                          'x\x9cgarbage')
+
+    def test_truncated(self):
+        """A body cut short fails the wrapped protocol, instead of raising.
+        """
+        collect = Collect()
+        protocol = _DeflateProtocol(collect, None)
+        protocol.dataReceived('x')
+        protocol.connectionLost(Failure(ResponseDone()))
+        self.assertTrue(collect.reason.check(ResponseFailed))
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def setUp(self):
+        # Retries are scheduled on a wheel that we can stop
+        self.wheel = TimerWheel()
+        self.patch(utils, 'timer_wheel', self.wheel)
+
+    def tearDown(self):
+        if self.wheel.call is not None and self.wheel.call.active():
+            self.wheel.call.cancel()
+
+    def send_once(self, error, idempotent):
+        """Have the first attempt fail, return the messages given up on.
+        """
+        failed = []
+        queue = OutboundQueue('test', lambda m, a: defer.fail(error),
+                              lambda m, err: failed.append(m),
+                              idempotent=idempotent)
+        self.addCleanup(queue.stop)
+        queue.put('message')
+        self.flushLoggedErrors(type(error))
+        return failed
+
+    def test_rate_limited(self):
+        """429s are retried by the scheduler, not again by the queue.
+        """
+        self.assertEqual(self.send_once(HTTPError(429, ''), True),
+                         ['message'])
+
+    def test_server_error(self):
+        self.assertEqual(self.send_once(HTTPError(503, ''), False), [])
+
+    def test_timeout(self):
+        """A POST that timed out might have been received, it's not retried.
+        """
+        self.assertEqual(self.send_once(defer.CancelledError(), True), [])
+        self.assertEqual(self.send_once(defer.CancelledError(), False),
+                         ['message'])
+
+    @defer.inlineCallbacks
+    def test_attempts(self):
+        """The attempt number is passed along, for the traces.
+        """
+        attempts = []
+
+        def send(message, attempt):
+            attempts.append(attempt)
+            if attempt == 1:
+                return defer.fail(HTTPError(503, ''))
+
+        queue = OutboundQueue('test', send, None, min_delay=0.01)
+        queue.put('message')
+        yield sleep(0.3)
+        self.assertEqual(attempts, [1, 2])
+        self.assertEqual(len(queue), 0)
+
+    def test_not_sent(self):
+        self.assertEqual(
+            self.send_once(ConnectionRefusedError(), False), [])
+        self.assertEqual(
+            self.send_once(CircuitOpenError('http://gitter'), False), [])
+
+
+    def test_failed_after_stop(self):
+        """Messages in flight when stopped are still reported if they fail.
+        """
+        sent = defer.Deferred()
+        failed = []
+        queue = OutboundQueue('test', lambda m, a: sent,
+                              lambda m, err: failed.append(m))
+        queue.put('message')
+        queue.stop()
+        sent.errback(HTTPError(503, ''))
+        self.flushLoggedErrors(HTTPError)
+        self.assertEqual(failed, ['message'])
+        self.assertEqual(len(queue), 0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_stale_outcome(self):
+        """Requests made before the circuit opened are not the probe.
+        """
+        breaker = CircuitBreaker('test', window=4, min_requests=2,
+                                 open_time=0)
+        old = breaker.allow()
+        failing = [breaker.allow() for i in xrange(2)]
+        for generation in failing:
+            breaker.record(generation, False, 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        probe = breaker.allow()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNone(breaker.allow())
+        # The old request finishing doesn't close the circuit
+        breaker.record(old, True, 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertIsNone(breaker.allow())
+
+        breaker.record(probe, True, 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertIsNotNone(breaker.allow())